@@ -0,0 +1,235 @@
+import asyncio
+import collections
+import functools
+
+from common import *
+from create import Writer
+from read import reader_for_file
+
+# How much of the archive AsyncReader buffers ahead of the reader,
+# such that the reader doesn't have to wait for the event loop in the middle of a call.
+default_read_ahead = 0x20000
+
+class AsyncWriter:
+    """
+    asyncio front-end for create.Writer.
+    stream_writer is an asyncio.StreamWriter or anything else with write() and an async drain().
+    Compression runs in the executor (default is the event loop's default executor),
+    and each call waits for the output to drain before returning, which respects backpressure from slow consumers.
+    Other keyword arguments are passed to Writer.
+    Calls are serialized, so there's at most one executor job per AsyncWriter at a time.
+    """
+    def __init__(self, stream_writer, executor=None, stream_split_threshold=0x10000, **kwargs):
+        self._stream_writer = stream_writer
+        self._executor = executor
+        self._lock = asyncio.Lock()
+        self._output = _OutputQueue()
+        # Writes the ArchiveHeader, which doesn't touch the stream_writer yet.
+        self._writer = Writer(root=None, output_path=self._output, stream_split_threshold=stream_split_threshold, **kwargs)
+
+    async def __aenter__(self): return self
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type == None:
+            await self.close()
+        else:
+            async with self._lock:
+                await self._run(self._writer.__exit__, exc_type, exc_value, traceback)
+
+    async def add_bytes(self, archive_path, data, file_type=FILE_TYPE_NORMAL_FILE):
+        async with self._lock:
+            await self._run(self._writer.add_bytes, archive_path, data, file_type)
+            await self._drain()
+
+    async def add_iter(self, archive_path, chunks, file_type=FILE_TYPE_NORMAL_FILE, size=None):
+        """ chunks is an async or regular iterable of bytes-like objects of any sizes. """
+        if not hasattr(chunks, "__aiter__"):
+            chunks = _to_async_iterable(chunks)
+        async with self._lock:
+            item = await self._run(self._writer.open_item, archive_path, file_type, size)
+            try:
+                pending = []
+                pending_size = 0
+                async for chunk in chunks:
+                    # Batch small chunks to amortize the trip to the executor.
+                    pending.append(chunk)
+                    pending_size += len(chunk)
+                    if pending_size < 0x10000: continue
+                    await self._run(_write_all, item, pending)
+                    pending = []
+                    pending_size = 0
+                    await self._drain()
+                await self._run(_write_all, item, pending)
+                await self._run(item.close)
+            finally:
+                # Only does anything if something failed, such as the source.
+                item.abort()
+            await self._drain()
+
+    async def add_stream(self, archive_path, stream_reader, file_type=FILE_TYPE_NORMAL_FILE, size=None):
+        """ Adds an item with the contents read from the given asyncio.StreamReader until EOF. """
+        await self.add_iter(archive_path, _read_stream(stream_reader), file_type, size)
+
+    async def add_directory(self, archive_path):
+        async with self._lock:
+            await self._run(self._writer.add_directory, archive_path)
+            await self._drain()
+
+    async def add_symlink(self, archive_path, target):
+        async with self._lock:
+            await self._run(self._writer.add_symlink, archive_path, target)
+            await self._drain()
+
+    async def close(self):
+        """ Finishes the archive. This does not close the stream_writer. """
+        async with self._lock:
+            await self._run(self._writer.close)
+            await self._drain()
+
+    def _run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args))
+
+    async def _drain(self):
+        while len(self._output.chunks) > 0:
+            self._stream_writer.write(self._output.chunks.popleft())
+            await self._stream_writer.drain()
+
+class _OutputQueue:
+    """ Output file for a Writer on a worker thread that AsyncWriter drains on the event loop. """
+    def __init__(self):
+        self.chunks = collections.deque()
+    def write(self, buf):
+        # The caller might reuse buf.
+        self.chunks.append(bytes(buf))
+        return len(buf)
+    def flush(self): pass
+
+def _write_all(item, chunks):
+    for chunk in chunks:
+        item.write(chunk)
+
+async def _to_async_iterable(iterable):
+    for x in iterable:
+        yield x
+
+async def _read_stream(stream_reader):
+    while True:
+        buf = await stream_reader.read(0x10000)
+        if len(buf) == 0: break
+        yield buf
+
+async def open_stream(source, executor=None, validate_index=True, read_ahead=default_read_ahead):
+    """
+    Returns an AsyncReader for a streaming read of the archive in source,
+    which is an asyncio.StreamReader or an async iterable of bytes-like objects, such as an HTTP request body.
+    """
+    stream = _AsyncInput(source, asyncio.get_running_loop())
+    await stream.fill(read_ahead)
+    reader = await asyncio.get_running_loop().run_in_executor(executor, functools.partial(reader_for_file, stream, validate_index=validate_index))
+    return AsyncReader(reader, executor, _input=stream, _read_ahead=read_ahead)
+
+class AsyncReader:
+    """
+    asyncio front-end for a reader from read.py, e.g. from open_path() or open_stream().
+    Decompression and file I/O run in the executor (default is the event loop's default executor).
+    Calls are serialized, so there's at most one executor job per AsyncReader at a time.
+    Iterate with 'async for'.
+    """
+    def __init__(self, reader, executor=None, *, _input=None, _read_ahead=default_read_ahead):
+        self.reader = reader
+        self._executor = executor
+        self._lock = asyncio.Lock()
+        self._input = _input
+        self._read_ahead = _read_ahead
+
+    async def __aenter__(self): return self
+    async def __aexit__(self, *args): await self.close()
+    def __aiter__(self): return self
+    async def __anext__(self):
+        item = await self._run(_next_or_none, self.reader)
+        if item == None: raise StopAsyncIteration
+        return item
+
+    async def open_item(self, item):
+        await self._run(self.reader.open_item, item)
+
+    async def read_from_item(self, item):
+        return await self._run(self.reader.read_from_item, item)
+
+    async def skip_item(self, item):
+        await self._run(self.reader.skip_item, item)
+
+    async def write_item_to(self, item, stream_writer):
+        """
+        Writes the rest of the item's contents to an asyncio.StreamWriter, or anything else with write() and an async drain(),
+        waiting for it to drain between chunks.
+        """
+        while not item.done:
+            stream_writer.write(await self.read_from_item(item))
+            await stream_writer.drain()
+
+    async def close(self):
+        await self._run(self.reader.close)
+
+    async def _run(self, fn, *args):
+        async with self._lock:
+            if self._input != None:
+                await self._input.fill(self._read_ahead)
+            return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args))
+
+def _next_or_none(reader):
+    # StopIteration can't be raised through a Future.
+    try:
+        return reader.next()
+    except StopIteration:
+        return None
+
+class _AsyncInput:
+    """
+    A blocking, non-seekable file-like object for a reader on a worker thread, fed from an async source on the event loop.
+    AsyncReader fills it ahead of each call, so the reader only has to wait for the event loop
+    when a single call needs more than the read-ahead, such as validating a large Index Region.
+    """
+    def __init__(self, source, loop):
+        if isinstance(source, asyncio.StreamReader):
+            source = _read_stream(source)
+        self._source = source.__aiter__()
+        self._loop = loop
+        self._chunks = collections.deque()
+        self._buffered_size = 0
+        self._position = 0
+        self._eof = False
+
+    async def fill(self, size):
+        while self._buffered_size < size and not self._eof:
+            try:
+                chunk = await self._source.__anext__()
+            except StopAsyncIteration:
+                self._eof = True
+                break
+            if len(chunk) == 0: continue
+            self._chunks.append(bytes(chunk))
+            self._buffered_size += len(chunk)
+
+    def seekable(self): return False
+    def tell(self): return self._position
+    def close(self):
+        self._chunks.clear()
+        self._buffered_size = 0
+
+    def read(self, n):
+        """ Like a buffered file, returns n bytes unless at EOF. """
+        if self._buffered_size < n and not self._eof:
+            # Called on a worker thread. Wait for the event loop.
+            asyncio.run_coroutine_threadsafe(self.fill(n), self._loop).result()
+        result = []
+        size = 0
+        while size < n and len(self._chunks) > 0:
+            chunk = self._chunks.popleft()
+            if size + len(chunk) > n:
+                self._chunks.appendleft(chunk[n - size:])
+                chunk = chunk[:n - size]
+            result.append(chunk)
+            size += len(chunk)
+        self._buffered_size -= size
+        self._position += size
+        return result[0] if len(result) == 1 else b"".join(result)
@@ -0,0 +1,70 @@
+import bisect
+import threading
+from collections import OrderedDict
+
+# Rough memory cost of a snapshot of a raw inflate decompressor: the 32KiB window plus the inflate state.
+decompressor_snapshot_size = 0xA000
+
+class CheckpointCache:
+    """
+    LRU cache of decompressor snapshots in the middle of Data Region compression streams.
+    Each checkpoint is keyed by (stream_start, offset), where offset is the number of decompressed bytes since stream_start,
+    and records input_position, the location in the archive of the next compressed byte to feed the decompressor.
+    A cache may be shared between readers of the same archive, but never between different archives.
+    A memory_budget of 0 disables the cache.
+    """
+    def __init__(self, memory_budget=0x1000000, interval=0x40000):
+        self.memory_budget = memory_budget
+        # Number of decompressed bytes between checkpoints while skipping through a stream.
+        self.interval = interval
+        self.memory_used = 0
+        self.hits = 0
+        self.misses = 0
+        self._checkpoints = OrderedDict() # (stream_start, offset) -> (decompressor, input_position, size)
+        self._offsets = {} # stream_start -> sorted list of offsets
+        self._lock = threading.Lock()
+
+    def find(self, stream_start, offset):
+        """
+        Returns (checkpoint_offset, decompressor, input_position) for the nearest checkpoint at or before offset,
+        or None if there isn't one.
+        The returned decompressor is a private copy that the caller is free to use.
+        """
+        with self._lock:
+            offsets = self._offsets.get(stream_start, ())
+            i = bisect.bisect_right(offsets, offset)
+            if i == 0:
+                self.misses += 1
+                return None
+            self.hits += 1
+            key = (stream_start, offsets[i - 1])
+            self._checkpoints.move_to_end(key)
+            decompressor, input_position, _ = self._checkpoints[key]
+            return key[1], decompressor.copy(), input_position
+
+    def put(self, stream_start, offset, decompressor, input_position):
+        """ Stores a copy of the given decompressor. """
+        size = decompressor_snapshot_size + len(decompressor.unconsumed_tail)
+        if size > self.memory_budget: return
+        key = (stream_start, offset)
+        with self._lock:
+            if key in self._checkpoints:
+                self._checkpoints.move_to_end(key)
+                return
+            self._checkpoints[key] = (decompressor.copy(), input_position, size)
+            bisect.insort(self._offsets.setdefault(stream_start, []), offset)
+            self.memory_used += size
+
+            # Evict least recently used.
+            while self.memory_used > self.memory_budget:
+                (evicted_stream_start, evicted_offset), (_, _, evicted_size) = self._checkpoints.popitem(last=False)
+                offsets = self._offsets[evicted_stream_start]
+                del offsets[bisect.bisect_left(offsets, evicted_offset)]
+                if len(offsets) == 0: del self._offsets[evicted_stream_start]
+                self.memory_used -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._checkpoints.clear()
+            self._offsets.clear()
+            self.memory_used = 0
@@ -13,6 +13,7 @@ class InvalidArchivePathError(PoafException): pass
 class MalformedInputError(PoafException): pass
 class IncompatibleInputError(PoafException): pass
 class ItemContentsTooLongError(PoafException): pass
+class ItemNotFoundError(PoafException): pass
 
 # Paths
 def validate_archive_path(archive_path, file_name_of_symlink=None):
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 
+import sys
 import zlib
+import itertools
 import struct, stat
-import os, re
+import os, re, errno
 import tempfile, shutil
+import queue
+import contextlib
 
 from common import *
+from parallel_crc import ParallelCrc32, crc32_combine, crc32_both
 
 def main():
     import argparse
@@ -13,10 +18,50 @@ def main():
 
     parser.add_argument("--stream-split-threshold", type=int, default=0x10000, help=
         "The minimum number of compressed bytes between stream splits to enable random-access jumping from the index.")
+    parser.add_argument("--split-by-uncompressed-size", action="store_true", help=
+        "Make --stream-split-threshold count uncompressed bytes instead, "
+        "such that the split points depend only on the input and the output is the same for any number of --jobs. "
+        "Implied by --jobs above 1.")
 
-    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("--max-skip-bytes", type=int, help=
+        "Split the stream before any item whose contents would otherwise be more than this many uncompressed bytes into its stream. "
+        "This bounds the work to open any item from the index regardless of the compression ratio. "
+        "Applies in addition to --stream-split-threshold, which can be set very high to split on this alone.")
+    parser.add_argument("--split-before-size", type=int, help=
+        "Split the stream before any file at least this big, such that opening it doesn't require skipping any items before it.")
+
+    parser.add_argument("-j", "--jobs", type=int, default=1, help=
+        "Compress this many compression streams at a time in parallel. "
+        "Because compressed sizes aren't known until a stream is done, "
+        "with more than 1 job, --stream-split-threshold counts uncompressed bytes. See --split-by-uncompressed-size.")
+
+    parser.add_argument("-l", "--level", type=int, default=zlib.Z_DEFAULT_COMPRESSION, choices=range(-1, 10), help=
+        "zlib compression level for the Data Region. Default is zlib's default.")
+    parser.add_argument("--adaptive-level", action="store_true", help=
+        "Store items that don't compress, such as JPEGs and gzipped files, without compression. "
+        "This is decided per item with a fast trial compression of the first 64KiB, "
+        "and changing the level splits the compression stream. "
+        "Items smaller than that join the current compression stream whatever its level.")
+
+    parser.add_argument("--order", choices=["given", "similar"], default="given", help=
+        "The order of items in the archive. "
+        "'given' is the order of the file arguments and directory walks. "
+        "'similar' reads the whole file list first and groups small files by extension, "
+        "such that similar files share a compression stream, and puts large files at the end. "
+        "Default is 'given'.")
+
+    parser.add_argument("-o", "--output", required=True, help=
+        "Path to write the archive to, or '-' for stdout, which may be a pipe.")
     parser.add_argument("--root", default=".", help=
         "See 'files'. Default is the current working directory.")
+    parser.add_argument("-r", "--recursive", action="store_true", help=
+        "Add the contents of directories recursively rather than the directories themselves. "
+        "Empty directories are still added as directory items.")
+    parser.add_argument("-T", "--files-from", metavar="PATH", help=
+        "Also read file arguments from the given file, or '-' for stdin, one per line. "
+        "This avoids command line length limits.")
+    parser.add_argument("-0", "--null", action="store_true", help=
+        "--files-from is delimited by null bytes rather than newlines.")
     parser.add_argument("files", nargs="*", help=
         "Each file argument may contain '->' followed by the path in the archive it will have. "
         "The last occurrence of '->' delimits the argument, which might be relevant if the host path actually contains a '->' string. "
@@ -25,26 +70,219 @@ def main():
 
     args = parser.parse_args()
 
-    with Writer(
+    if args.files_from == None or args.files_from == "-":
+        # Not ours to close.
+        file_list = contextlib.nullcontext(sys.stdin.buffer if args.files_from == "-" else None)
+    else:
+        file_list = open(args.files_from, "rb")
+
+    with file_list as file_list, Writer(
         root=args.root,
-        output_path=args.output,
+        output_path=sys.stdout.buffer if args.output == "-" else args.output,
         stream_split_threshold=args.stream_split_threshold,
+        split_by_uncompressed_size=args.split_by_uncompressed_size,
+        jobs=args.jobs,
+        level=args.level,
+        adaptive_level=args.adaptive_level,
+        max_skip_bytes=args.max_skip_bytes,
+        split_before_size=args.split_before_size,
     ) as writer:
-        for file in args.files:
-            writer.add(file)
+        file_args = args.files
+        if file_list != None:
+            file_args = itertools.chain(file_args, read_file_list(file_list, b"\0" if args.null else b"\n"))
+        # Stop the background thread before the file list is closed.
+        with contextlib.closing(prefetch(find_entries(file_args, args.root, args.recursive))) as entries:
+            if args.order == "similar":
+                entries = order_by_similarity(entries)
+            for input_path, archive_path, file_type, _ in entries:
+                writer.add_entry(input_path, archive_path, file_type)
+
+def find_entries(file_args, root, recursive=False):
+    """
+    Generates (input_path, archive_path, file_type, size) for each of the given command line style file arguments.
+    size is the st_size of a file from the stat that determined its type, or None if the type was given explicitly or it's not a file.
+    With recursive=True, directories are walked with os.scandir(),
+    and only empty directories are included as directory items.
+    """
+    for file_arg in file_args:
+        try:
+            input_path, archive_path = file_arg.rsplit("->", 1)
+        except ValueError:
+            input_path = file_arg
+            archive_path = os.path.relpath(input_path, root)
+            # Canonicalize slash direction.
+            archive_path = archive_path.replace(os.path.sep, "/")
+        try:
+            type_code, archive_path = archive_path.split(":", 1)
+        except ValueError:
+            type_code = None # Infer
+
+        # Compute metadata.
+        size = None
+        if type_code == None:
+            st = os.stat(input_path, follow_symlinks=False)
+            file_type = file_type_from_stat(st, input_path)
+            if stat.S_ISREG(st.st_mode): size = st.st_size
+            if recursive and file_type == FILE_TYPE_DIRECTORY:
+                # The archive root itself is never an item.
+                archive_dir = "" if archive_path == "." else archive_path
+                found_anything = False
+                for entry in _walk(input_path, archive_dir):
+                    found_anything = True
+                    yield entry
+                if found_anything or archive_dir == "": continue
+        elif type_code == "f": file_type = FILE_TYPE_NORMAL_FILE
+        elif type_code == "x": file_type = FILE_TYPE_POSIX_EXECUTABLE
+        elif type_code == "d": file_type = FILE_TYPE_DIRECTORY
+        elif type_code == "l": file_type = FILE_TYPE_SYMLINK
+        else: raise Exception("unrecognized type code: " + repr(type_code))
+        yield input_path, archive_path, file_type, size
+
+def _walk(dir_path, archive_dir):
+    # Sort for reproducible archives.
+    with os.scandir(dir_path) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        archive_path = archive_dir + "/" + entry.name if archive_dir else entry.name
+        # The DirEntry caches the lstat() result.
+        st = entry.stat(follow_symlinks=False)
+        file_type = file_type_from_stat(st, entry.path)
+        if file_type == FILE_TYPE_DIRECTORY:
+            found_anything = False
+            for child in _walk(entry.path, archive_path):
+                found_anything = True
+                yield child
+            if found_anything: continue
+            # Explicitly include empty directories.
+        yield entry.path, archive_path, file_type, st.st_size if stat.S_ISREG(st.st_mode) else None
+
+def file_type_from_stat(st, input_path):
+    if stat.S_ISREG(st.st_mode):
+        if st.st_mode & 0o111:
+            return FILE_TYPE_POSIX_EXECUTABLE
+        else:
+            return FILE_TYPE_NORMAL_FILE
+    elif stat.S_ISDIR(st.st_mode):
+        return FILE_TYPE_DIRECTORY
+    elif stat.S_ISLNK(st.st_mode):
+        return FILE_TYPE_SYMLINK
+    else:
+        raise Exception("obscure file type: " + input_path)
+
+# Files at least this big get their own compression streams anyway.
+large_file_size = 0x100000
+
+def order_by_similarity(entries):
+    """
+    Returns the given (input_path, archive_path, file_type, size) entries from find_entries() sorted for a better compression ratio:
+    small files grouped by extension and then by path, followed by large files.
+    Items with duplicate names keep their relative order.
+    """
+    keys = {}
+    def key(entry):
+        input_path, archive_path, file_type, size = entry
+        # Sort duplicates together, with the first one still first.
+        if archive_path in keys: return keys[archive_path]
+        if file_type not in (FILE_TYPE_NORMAL_FILE, FILE_TYPE_POSIX_EXECUTABLE):
+            size = 0
+        elif size == None:
+            # The type was given explicitly, so find_entries() didn't stat it.
+            size = os.stat(input_path).st_size
+        base_name = archive_path.rsplit("/", 1)[-1]
+        extension = base_name.rsplit(".", 1)[-1].lower() if "." in base_name[1:] else ""
+        k = (size >= large_file_size, extension, archive_path)
+        keys[archive_path] = k
+        return k
+    # sorted() is stable.
+    return sorted(entries, key=key)
+
+def read_file_list(file, delimiter):
+    """ Generates file arguments from a binary file delimited by the given byte. """
+    remainder = b""
+    while True:
+        buf = file.read(0x10000)
+        if len(buf) == 0: break
+        lines = (remainder + buf).split(delimiter)
+        remainder = lines.pop()
+        for line in lines:
+            if len(line) > 0: yield os.fsdecode(line)
+    if len(remainder) > 0: yield os.fsdecode(remainder)
+
+def prefetch(iterable, max_pending=0x1000):
+    """
+    Runs the given iterable on a background thread, such as to overlap os.stat() and os.scandir() calls with compression.
+    Closing the returned generator stops the thread before its next item.
+    """
+    import threading
+    items = queue.Queue(maxsize=max_pending)
+    done = object()
+    stopped = threading.Event()
+    def put(item):
+        """ Returns False if the consumer is gone. """
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def run():
+        try:
+            for item in iterable:
+                if not put((item, None)): return
+        except BaseException as e:
+            put((done, e))
+        else:
+            put((done, None))
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error != None: raise error
+                return
+            yield item
+    finally:
+        stopped.set()
 
 class Writer:
-    def __init__(self, root, output_path, stream_split_threshold):
+    def __init__(self, root, output_path, stream_split_threshold, jobs=1, level=zlib.Z_DEFAULT_COMPRESSION, adaptive_level=False, max_skip_bytes=None, split_before_size=None, split_by_uncompressed_size=False):
         self.root = root
         self.stream_split_threshold = stream_split_threshold
+        self.split_by_uncompressed_size = split_by_uncompressed_size
+        self.max_skip_bytes = max_skip_bytes
+        self.split_before_size = split_before_size
+        self.level = level
+        self.adaptive_level = adaptive_level
+        self._item_writer = None
+        # The archive path of an item that was aborted after some of it was written, which makes the archive unfinishable.
+        self._aborted_item = None
+        # Reused by ItemWriter.write_from().
+        self._chunk_buffer = None
 
-        self._output = open(output_path, "wb")
+        # With multiple jobs, each compression stream is a _Segment compressed on a worker thread,
+        # and segments are written to the output in order as they finish.
+        self._executor = None
+        if jobs > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(jobs)
+            self._max_pending_segments = 2 * jobs
+            self._pending_segments = []
+            self._segment = None
+        # Computes the crc32s of large writes in parallel, given multiple jobs.
+        self._parallel_crc32 = ParallelCrc32(jobs) if jobs > 1 else None
+
+        if hasattr(output_path, "write"):
+            # Caller is responsible for closing it.
+            self._output = _CountingOutput(output_path, close_file=False)
+        else:
+            self._output = _CountingOutput(open(output_path, "wb"), close_file=True)
         try:
             # ArchiveHeader
             self._output.write(archive_header)
 
             # Data Region
-            self._start_stream()
+            self._start_stream(level)
 
             # Start the index
             self._index_crc32 = 0
@@ -52,6 +290,9 @@ class Writer:
             self._index_tmpfile = tempfile.TemporaryFile()
         except:
             self._output.close()
+            if self._executor != None:
+                self._executor.shutdown()
+                self._parallel_crc32.close()
             raise
 
     def __enter__(self):
@@ -65,103 +306,122 @@ class Writer:
                     self._index_tmpfile.close()
             finally:
                 self._output.close()
+                if self._executor != None:
+                    for segment in self._pending_segments + [self._segment]:
+                        if segment != None:
+                            segment.abort()
+                    self._executor.shutdown()
+                    self._parallel_crc32.close()
             raise
 
-    def add(self, input_path):
-        try:
-            input_path, archive_path = input_path.rsplit("->", 1)
-        except ValueError:
-            archive_path = os.path.relpath(input_path, self.root)
-            # Canonicalize slash direction.
-            archive_path = archive_path.replace(os.path.sep, "/")
-        try:
-            type_code, archive_path = archive_path.split(":", 1)
-        except ValueError:
-            type_code = None # Infer
-        name = validate_archive_path(archive_path)
+    def add(self, input_path, recursive=False):
+        """
+        input_path is in the format of a command line argument. See main().
+        If recursive is True and input_path is a directory, adds its contents instead.
+        """
+        for input_path, archive_path, file_type, _ in find_entries([input_path], self.root, recursive):
+            self.add_entry(input_path, archive_path, file_type)
 
-        # Compute metadata.
-        if type_code == None:
-            st = os.stat(input_path, follow_symlinks=False)
-            if stat.S_ISREG(st.st_mode):
-                if st.st_mode & 0o111:
-                    file_type = FILE_TYPE_POSIX_EXECUTABLE
-                else:
-                    file_type = FILE_TYPE_NORMAL_FILE
-            elif stat.S_ISDIR(st.st_mode):
-                file_type = FILE_TYPE_DIRECTORY
-            elif stat.S_ISLNK(st.st_mode):
-                file_type = FILE_TYPE_SYMLINK
-            else:
-                raise Exception("obscure file type: " + input_path)
-        elif type_code == "f": file_type = FILE_TYPE_NORMAL_FILE
-        elif type_code == "x": file_type = FILE_TYPE_POSIX_EXECUTABLE
-        elif type_code == "d": file_type = FILE_TYPE_DIRECTORY
-        elif type_code == "l": file_type = FILE_TYPE_SYMLINK
-        else: raise Exception("unrecognized type code: " + repr(type_code))
-        type_and_name_size = (file_type << 14) | len(name)
+    def add_entry(self, input_path, archive_path, file_type):
+        """ Adds the file at input_path on the host filesystem as the given archive path and file type. """
+        if file_type in (FILE_TYPE_NORMAL_FILE, FILE_TYPE_POSIX_EXECUTABLE):
+            # Unbuffered, because ItemWriter.write_from() reads into its own buffer.
+            with open(input_path, "rb", buffering=0) as f:
+                with ItemWriter(self, archive_path, file_type, os.fstat(f.fileno()).st_size) as item:
+                    item.write_from(f)
+        elif file_type == FILE_TYPE_DIRECTORY:
+            self.add_directory(archive_path)
+        elif file_type == FILE_TYPE_SYMLINK:
+            self.add_symlink(archive_path, os.readlink(input_path))
+        else: assert False
 
-        # Write DataItem pre-contents fields.
-        out_buf = (
-            streaming_signature +
-            struct.pack("<H", type_and_name_size) +
-            name
-        )
-        self._write(out_buf)
-        streaming_crc32 = zlib.crc32(out_buf)
+    def add_bytes(self, archive_path, data, file_type=FILE_TYPE_NORMAL_FILE):
+        """ Adds an item with the given contents, which is any bytes-like object. """
+        view = memoryview(data).cast("B")
+        position = 0
+        def read_chunk(size):
+            nonlocal position
+            buf = view[position:position + size]
+            position += len(buf)
+            return buf
+        try:
+            self._add_item(archive_path, file_type, read_chunk, len(view))
+        finally:
+            view.release()
 
-        # Compute jump_location and possibly split compression stream.
-        # We might want to split here.
-        # TODO: can't use tell() on pipes. We need to track the bytes written ourselves.
-        if self._output.tell() - self._stream_start < self.stream_split_threshold:
-            # Nah, not yet.
-            jump_location = 0
-        else:
-            # Yes, split the stream.
-            self._output.write(self._compressor.flush())
-            jump_location = self._output.tell() # Note, have to re-tell() after the above flush()
-            self._start_stream()
+    def add_stream(self, archive_path, file, file_type=FILE_TYPE_NORMAL_FILE, size=None):
+        """
+        Adds an item with the contents read from the given binary file object until EOF, such as a pipe, socket, or HTTP response.
+        size is optional, and is only used to make stream split decisions.
+        """
+        def read_chunk(size):
+            buf = file.read(size)
+            # Pipes and sockets can return less than asked for before the end.
+            while 0 < len(buf) < size:
+                more = file.read(size - len(buf))
+                if len(more) == 0: break
+                buf += more
+            return buf
+        self._add_item(archive_path, file_type, read_chunk, size)
 
-        # Contents
-        file_size = 0
-        contents_crc32 = 0
-        if file_type in (FILE_TYPE_NORMAL_FILE, FILE_TYPE_POSIX_EXECUTABLE):
-            with open(input_path, "rb") as f:
-                while True:
-                    buf = f.read(0xffff)
-                    out_buf = (
-                        struct.pack("<H", len(buf)) +
-                        buf
-                    )
-                    self._write(out_buf)
-                    streaming_crc32 = zlib.crc32(out_buf, streaming_crc32)
+    def add_iter(self, archive_path, chunks, file_type=FILE_TYPE_NORMAL_FILE, size=None):
+        """
+        Adds an item with the contents given by an iterable of bytes-like objects of any sizes, such as a generator.
+        size is optional, and is only used to make stream split decisions.
+        """
+        chunks = iter(chunks)
+        pending = bytearray()
+        def read_chunk(size):
+            while len(pending) < size:
+                chunk = next(chunks, None)
+                if chunk == None: break
+                pending.extend(chunk)
+            buf = bytes(pending[:size])
+            del pending[:size]
+            return buf
+        self._add_item(archive_path, file_type, read_chunk, size)
 
-                    file_size += len(buf)
-                    contents_crc32 = zlib.crc32(buf, contents_crc32)
+    def add_directory(self, archive_path):
+        self._add_item(archive_path, FILE_TYPE_DIRECTORY, lambda size: b"")
 
-                    if len(buf) < 0xffff: break
+    def add_symlink(self, archive_path, target):
+        """ target is a str. """
+        buf = validate_archive_path(target, file_name_of_symlink=archive_path)
+        self.add_bytes(archive_path, buf, FILE_TYPE_SYMLINK)
 
-        elif file_type == FILE_TYPE_DIRECTORY:
-            out_buf = b"\x00\x00"
-            self._write(out_buf)
-            streaming_crc32 = zlib.crc32(out_buf, streaming_crc32)
-        elif file_type == FILE_TYPE_SYMLINK:
-            link_target_str = os.readlink(input_path)
-            buf = validate_archive_path(link_target_str, file_name_of_symlink=archive_path)
-            out_buf = (
-                struct.pack("<H", len(buf)) +
-                buf
-            )
-            self._write(out_buf)
-            streaming_crc32 = zlib.crc32(out_buf, streaming_crc32)
-            file_size += len(buf)
-            contents_crc32 = zlib.crc32(buf, contents_crc32)
-        else: assert False
+    def open_item(self, archive_path, file_type=FILE_TYPE_NORMAL_FILE, size=None):
+        """
+        Returns an ItemWriter to write the contents of a new item incrementally.
+        No other item can be added until it is closed.
+        size is optional, and is only used to make stream split decisions.
+        """
+        return ItemWriter(self, archive_path, file_type, size)
 
-        # DataItem fields after the contents
-        self._write(struct.pack("<L", streaming_crc32))
+    def _add_item(self, archive_path, file_type, read_chunk, size=None):
+        """
+        read_chunk(size) returns the next size bytes of the contents, or fewer only at the end.
+        """
+        with ItemWriter(self, archive_path, file_type, size) as item:
+            while True:
+                buf = read_chunk(0xffff)
+                item.write(buf)
+                if len(buf) < 0xffff: break
 
-        # IndexItem
+    def _should_split(self, level, size):
+        """ Decides whether to split the stream between the current item's header and its contents. """
+        if self._stream_level != level:
+            return True
+        # This is how many bytes a reader would need to inflate and discard to get to this item's contents.
+        if self.max_skip_bytes != None and self._stream_uncompressed_size > self.max_skip_bytes:
+            return True
+        if self.split_before_size != None and size != None and size >= self.split_before_size:
+            return True
+        if self.split_by_uncompressed_size or self._executor != None:
+            # We don't know the compressed size yet with parallel jobs.
+            return self._stream_uncompressed_size >= self.stream_split_threshold
+        return self._output.tell() - self._stream_start >= self.stream_split_threshold
+
+    def _add_index_item(self, jump_location, file_size, contents_crc32, type_and_name_size, name):
         out_buf = (
             struct.pack("<QQLH",
                 jump_location,
@@ -175,8 +435,17 @@ class Writer:
         self._index_crc32 = zlib.crc32(out_buf, self._index_crc32)
 
     def close(self):
+        self._check_not_aborted()
         # End the Data Region
-        self._output.write(self._compressor.flush())
+        if self._executor != None:
+            if self._segment != None:
+                self._finish_segment()
+            self._write_segments(wait_for_all=True)
+            self._executor.shutdown()
+            self._parallel_crc32.close()
+        elif self._compressor != None:
+            self._output.write(self._compressor.flush())
+        # Otherwise the Data Region ended with a stream copied verbatim. See rewrite.py.
         self._compressor = None
 
         # Index Region.
@@ -201,17 +470,357 @@ class Writer:
         # Done
         self._output.close()
 
+    def _check_not_aborted(self):
+        if self._aborted_item != None: raise ValueError("can't finish the archive after aborting a partially written item: " + self._aborted_item)
+
     def _write(self, buf):
-        self._output.write(self._compressor.compress(buf))
+        self._stream_uncompressed_size += len(buf)
+        if self._executor != None:
+            self._segment.write(buf)
+        else:
+            self._output.write(self._compressor.compress(buf))
     def _write_to_index(self, buf):
         self._index_tmpfile.write(self._index_compressor.compress(buf))
 
-    def _start_stream(self):
-        self._compressor = Compressor()
+    def _start_stream(self, level):
+        self._stream_level = level
+        self._stream_uncompressed_size = 0
+        if self._executor != None:
+            self._segment = _Segment(self._executor, level)
+            return
+        self._compressor = Compressor(level)
         self._stream_start = self._output.tell()
 
-def Compressor():
-    return zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    def _finish_segment(self):
+        self._segment.finish()
+        self._pending_segments.append(self._segment)
+        self._segment = None
+        self._write_segments(wait_for_all=False)
+
+    def _write_segments(self, wait_for_all):
+        """
+        Writes finished segments to the output in order, and then their IndexItems now that we know where they are.
+        Blocks if too many segments are pending.
+        """
+        while len(self._pending_segments) > 0:
+            segment = self._pending_segments[0]
+            if not (wait_for_all or segment.done() or len(self._pending_segments) > self._max_pending_segments):
+                break
+            del self._pending_segments[0]
+
+            stream_start = self._output.tell()
+            with segment.result() as compressed:
+                shutil.copyfileobj(compressed, self._output)
+            for (jump_location, *rest) in segment.index_items:
+                if jump_location == None:
+                    # This item's contents are at the start of this segment.
+                    jump_location = stream_start
+                self._add_index_item(jump_location, *rest)
+
+# How many chunks ItemWriter.write_from() reads at a time given multiple jobs.
+parallel_crc32_chunk_count = 64
+
+class ItemWriter:
+    """
+    A writable file-like object for the contents of one item. See Writer.open_item().
+    Nothing is written for the item until its first 0xffff bytes are known, or it's closed.
+    """
+    def __init__(self, writer, archive_path, file_type, size):
+        if writer._item_writer != None: raise ValueError("close the previous item first")
+        writer._check_not_aborted()
+        self._writer = writer
+        self._archive_path = archive_path
+        self._name = validate_archive_path(archive_path)
+        self._file_type = file_type
+        self._size = size
+        self._pending = bytearray()
+        self._started = False
+        self._file_size = 0
+        self._contents_crc32 = 0
+        self.closed = False
+        writer._item_writer = self
+
+    def __enter__(self): return self
+    def __exit__(self, exc_type, *args):
+        # If something went wrong, there's no way to finish the item correctly.
+        if exc_type == None: self.close()
+        else: self.abort()
+
+    def write(self, buf):
+        if self.closed: raise ValueError("write to closed item")
+        with memoryview(buf) as view, view.cast("B") as view:
+            position = 0
+            if len(self._pending) > 0:
+                position = min(len(view), 0xffff - len(self._pending))
+                self._pending += view[:position]
+                if len(self._pending) < 0xffff: return len(view)
+                self._write_chunk(self._pending)
+                self._pending.clear()
+            # Full chunks can be written as soon as we have them.
+            full_size = (len(view) - position) // 0xffff * 0xffff
+            self._write_chunks(view[position:position + full_size])
+            position += full_size
+            self._pending += view[position:]
+            return len(view)
+
+    def write_from(self, file):
+        """
+        Writes the rest of the given binary file's contents.
+        This reads with readinto() into a buffer that's reused for every chunk, and is the fast path for large files.
+        """
+        if self.closed: raise ValueError("write to closed item")
+        if len(self._pending) > 0:
+            # Complete the pending chunk first. Pipes and sockets can return less than asked for before the end.
+            while True:
+                buf = file.read(0xffff - len(self._pending))
+                if buf == None: raise BlockingIOError(errno.EAGAIN, "write_from() requires a blocking file")
+                if len(buf) == 0: return
+                self.write(buf)
+                if len(self._pending) == 0: break
+        if self._writer._chunk_buffer == None:
+            # With parallel crc32s, read enough chunks at a time to keep the threads busy.
+            chunk_count = 1 if self._writer._parallel_crc32 == None else parallel_crc32_chunk_count
+            self._writer._chunk_buffer = bytearray(0xffff * chunk_count)
+        with memoryview(self._writer._chunk_buffer) as view:
+            while True:
+                size = 0
+                while size < len(view):
+                    n = file.readinto(view[size:])
+                    if n == None: raise BlockingIOError(errno.EAGAIN, "write_from() requires a blocking file")
+                    if n == 0: break
+                    size += n
+                full_size = size // 0xffff * 0xffff
+                self._write_chunks(view[:full_size])
+                if size < len(view):
+                    # The rest will be the last chunk.
+                    self._pending += view[full_size:size]
+                    return
+
+    def close(self):
+        if self.closed: return
+        # The last chunk is always less than 0xffff bytes, even if it's empty.
+        self._write_chunk(self._pending)
+        self._pending = None
+        self.closed = True
+        writer = self._writer
+        writer._item_writer = None
+
+        # DataItem fields after the contents
+        writer._write(struct.pack("<L", self._streaming_crc32))
+
+        # IndexItem
+        type_and_name_size = (self._file_type << 14) | len(self._name)
+        if writer._executor != None:
+            # Wait until we know the jump_location.
+            writer._segment.index_items.append((self._jump_location, self._file_size, self._contents_crc32, type_and_name_size, self._name))
+        else:
+            writer._add_index_item(self._jump_location, self._file_size, self._contents_crc32, type_and_name_size, self._name)
+
+    def abort(self):
+        """
+        Gives up on the item, such as when its source failed, and frees the Writer for other items.
+        That leaves no trace of the item if nothing was written for it yet. See the class docstring.
+        Otherwise the archive can't be finished, and adding items or closing the Writer raises ValueError.
+        """
+        if self.closed: return
+        self._pending = None
+        self.closed = True
+        self._writer._item_writer = None
+        if self._started: self._writer._aborted_item = self._archive_path
+
+    def _write_chunks(self, view):
+        """ Writes any number of full chunks, computing their crc32s in parallel given multiple jobs. """
+        if self._writer._parallel_crc32 == None:
+            crcs = itertools.repeat(None)
+        else:
+            crcs = self._writer._parallel_crc32.chunk_crc32s(view, 0xffff)
+        for position, crc in zip(range(0, len(view), 0xffff), crcs):
+            self._write_chunk(view[position:position + 0xffff], crc)
+
+    def _write_chunk(self, buf, buf_crc32=None):
+        writer = self._writer
+        if not self._started:
+            self._started = True
+            self._start(buf)
+
+        # Written separately rather than concatenated to avoid copying the contents.
+        chunk_size_buf = struct.pack("<H", len(buf))
+        writer._write(chunk_size_buf)
+        writer._write(buf)
+        self._streaming_crc32 = zlib.crc32(chunk_size_buf, self._streaming_crc32)
+        if buf_crc32 == None:
+            self._streaming_crc32, self._contents_crc32 = crc32_both(buf, self._streaming_crc32, self._contents_crc32)
+        else:
+            self._streaming_crc32 = crc32_combine(self._streaming_crc32, buf_crc32, len(buf))
+            self._contents_crc32 = crc32_combine(self._contents_crc32, buf_crc32, len(buf))
+
+        self._file_size += len(buf)
+
+    def _start(self, buf):
+        """ buf is the first chunk of the contents. """
+        writer = self._writer
+
+        # Write DataItem pre-contents fields.
+        out_buf = self._header()
+        writer._write(out_buf)
+        self._streaming_crc32 = zlib.crc32(out_buf)
+
+        # Look at the start of the contents before deciding on the compression level.
+        level = writer.level
+        # Items too small to sample aren't worth a stream split for their level alone,
+        # so they can join the current stream whatever its level, but a new stream starts at the default.
+        split_level = writer._stream_level
+        if writer.adaptive_level and len(buf) == 0xffff:
+            level = split_level = choose_compression_level(buf, level)
+
+        # Compute jump_location and possibly split compression stream.
+        # We might want to split here.
+        if not writer._should_split(split_level, self._size):
+            # Nah, not yet.
+            self._jump_location = 0
+        elif writer._executor != None:
+            # We won't know the jump_location until the previous segments are done.
+            writer._finish_segment()
+            writer._start_stream(level)
+            self._jump_location = None
+        else:
+            # Yes, split the stream.
+            writer._output.write(writer._compressor.flush())
+            self._jump_location = writer._output.tell() # Note, have to re-tell() after the above flush()
+            writer._start_stream(level)
+
+    def _header(self):
+        return data_item_header(self._name, self._file_type)
+
+def data_item_header(name, file_type):
+    """ Returns the DataItem fields before the contents. name is the validated bytes. """
+    type_and_name_size = (file_type << 14) | len(name)
+    return (
+        streaming_signature +
+        struct.pack("<H", type_and_name_size) +
+        name
+    )
+
+class _CountingOutput:
+    """
+    Buffers writes into large blocks and counts the bytes written so that tell() works on pipes and sockets.
+    """
+    def __init__(self, file, close_file, block_size=0x40000):
+        self._file = file
+        self._close_file = close_file
+        self._block_size = block_size
+        self._buffer = bytearray()
+        self._position = 0
+
+    def write(self, buf):
+        self._position += len(buf)
+        if len(self._buffer) + len(buf) < self._block_size:
+            self._buffer += buf
+            return
+        if len(self._buffer) > 0:
+            self._buffer += buf
+            self._write_all(self._buffer)
+            self._buffer.clear()
+        else:
+            # Large writes go straight through.
+            self._write_all(buf)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        if len(self._buffer) > 0:
+            self._write_all(self._buffer)
+            self._buffer.clear()
+        self._file.flush()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._close_file:
+                self._file.close()
+
+    def _write_all(self, buf):
+        # Raw and non-blocking files might do short writes.
+        with memoryview(buf) as view:
+            written = 0
+            while written < len(view):
+                n = self._file.write(view[written:])
+                if n == None: n = len(view) - written
+                written += n
+
+class _Segment:
+    """
+    A compression stream in the Data Region compressed on a worker thread.
+    Compressed output is held in a spooled tempfile until it's written to the archive.
+    """
+    def __init__(self, executor, level):
+        self._level = level
+        # (jump_location, file_size, contents_crc32, type_and_name_size, name) for items whose contents start in this segment.
+        # jump_location is None for the item at the start of the segment.
+        self.index_items = []
+        self._buffer = bytearray()
+        self._queue = queue.Queue(maxsize=16)
+        self._future = executor.submit(self._compress)
+
+    def write(self, buf):
+        # Don't bother the worker with tiny writes.
+        self._buffer += buf
+        if len(self._buffer) >= 0x10000:
+            # Hand over the buffer rather than copying it.
+            self._queue.put(self._buffer)
+            self._buffer = bytearray()
+
+    def finish(self):
+        if len(self._buffer) > 0:
+            self._queue.put(self._buffer)
+        self._buffer = None
+        self._queue.put(None)
+
+    def abort(self):
+        # Make sure the worker isn't waiting for more.
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._queue.put(None)
+
+    def done(self): return self._future.done()
+    def result(self): return self._future.result()
+
+    def _compress(self):
+        compressed = tempfile.SpooledTemporaryFile(max_size=0x400000)
+        buf = b""
+        try:
+            compressor = Compressor(self._level)
+            while True:
+                buf = self._queue.get()
+                if buf == None: break
+                compressed.write(compressor.compress(buf))
+            compressed.write(compressor.flush())
+        except:
+            compressed.close()
+            # Don't leave the main thread blocked trying to give us more.
+            while buf != None:
+                buf = self._queue.get()
+            raise
+        compressed.seek(0)
+        return compressed
+
+def Compressor(level=zlib.Z_DEFAULT_COMPRESSION):
+    return zlib.compressobj(level, wbits=-zlib.MAX_WBITS)
+
+def choose_compression_level(sample, level):
+    """
+    Returns the compression level to use for contents starting with sample.
+    Data that a fast trial compression can't shrink, e.g. JPEGs and gzipped files, gets level 0,
+    which is much faster than letting DEFLATE try and fall back to stored blocks anyway.
+    """
+    if len(zlib.compress(sample, 1)) >= len(sample) * 0.97:
+        return 0
+    return level
 
 if __name__ == "__main__":
     main()
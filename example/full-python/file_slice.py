@@ -1,3 +1,5 @@
+import os, stat
+import mmap
 
 class FileSlice:
     """
@@ -17,3 +19,49 @@ class FileSlice:
         buf = self.file.read(n)
         self.start += len(buf)
         return buf
+
+class BufferSlice:
+    """
+    like FileSlice, but for a bytes-like object such as an mmap.
+    read(n) returns zero-copy memoryview slices of the buffer.
+    """
+    def __init__(self, buffer, start, end):
+        self.buffer = memoryview(buffer)
+        self.start = start
+        self.end = min(end, len(self.buffer))
+    def read(self, n):
+        n = max(0, min(n, self.end - self.start))
+        buf = self.buffer[self.start:self.start + n]
+        self.start += n
+        return buf
+    def tell(self):
+        return self.start
+
+def map_file(file):
+    """
+    Returns a read-only mmap of the entire file if it's a regular file, otherwise None.
+    """
+    try:
+        fileno = file.fileno()
+    except (AttributeError, OSError):
+        # e.g. io.BytesIO
+        return None
+    st = os.fstat(fileno)
+    if not stat.S_ISREG(st.st_mode) or st.st_size == 0: return None
+    try:
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+def release_buffer(buffer):
+    """
+    Releases a memoryview, and closes the underlying object if it's an mmap.
+    """
+    obj = buffer.obj
+    buffer.release()
+    if isinstance(obj, mmap.mmap):
+        try:
+            obj.close()
+        except BufferError:
+            # Somebody is still holding a slice. The mapping will be closed when that's garbage collected.
+            pass
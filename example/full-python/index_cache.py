@@ -0,0 +1,170 @@
+import sys, os
+import struct
+import zlib
+from array import array
+
+from file_slice import map_file, release_buffer
+
+index_cache_signature = b"poafidx\x01"
+
+# signature, archive_footer, archive_size, archive_mtime_ns, item_count, names_size, slot_count, crc32 of everything after the header
+_header = struct.Struct("<8s16sQQQQQL")
+# jump_location, file_size, stream_start, skip_bytes_until_contents, name_offset, contents_crc32, type_and_name_size
+_record = struct.Struct("<QQQQQLH")
+_slot = struct.Struct("<Q")
+
+class IndexCache:
+    """
+    A sidecar file (e.g. archive.poaf.idx) caching the parsed Index Region of an archive,
+    including the precomputed random-access offsets of every item and a hash table for lookup by name.
+
+    Layout: header, then a fixed-size record per item, then all the names, then the hash table.
+    The hash table is open addressing with linear probing keyed by the crc32 of the name,
+    with each slot holding 1 + the record number, or 0 for empty.
+    Only the first item with any given name is in the hash table.
+
+    The cache is keyed by the ArchiveFooter, size, and mtime of the archive,
+    and a crc32 in the header covers the rest, such that a damaged sidecar is just rebuilt.
+    The sidecar is memory-mapped, so opening it costs no more than a crc32 pass regardless of the number of items.
+    """
+    def __init__(self, buffer, item_count, names_size, slot_count):
+        self._buffer = buffer
+        self._item_count = item_count
+        self._records_start = _header.size
+        self._names_start = self._records_start + item_count * _record.size
+        self._slots_start = self._names_start + names_size
+        self._slot_count = slot_count
+
+    def __len__(self):
+        return self._item_count
+
+    def record(self, i):
+        """
+        Returns (jump_location, file_size, file_type, name, contents_crc32, stream_start, skip_bytes_until_contents)
+        where name is a bytes-like object.
+        """
+        (
+            jump_location,
+            file_size,
+            stream_start,
+            skip_bytes_until_contents,
+            name_offset,
+            contents_crc32,
+            type_and_name_size,
+        ) = _record.unpack_from(self._buffer, self._records_start + i * _record.size)
+        file_type, name_size = type_and_name_size >> 14, type_and_name_size & 0x3FFF
+        name_start = self._names_start + name_offset
+        name = self._buffer[name_start:name_start + name_size]
+        return jump_location, file_size, file_type, name, contents_crc32, stream_start, skip_bytes_until_contents
+
+    def find(self, name):
+        """ Returns the record number of the first item with the given name (bytes), or None. """
+        mask = self._slot_count - 1
+        slot = zlib.crc32(name) & mask
+        while True:
+            (value,) = _slot.unpack_from(self._buffer, self._slots_start + slot * 8)
+            if value == 0: return None
+            if self.record(value - 1)[3] == name: return value - 1
+            slot = (slot + 1) & mask
+
+    def close(self):
+        release_buffer(self._buffer)
+
+def cache_key(file, archive_footer):
+    """ Returns an opaque key for the given archive file, or None if the file can't be identified. """
+    try:
+        st = os.fstat(file.fileno())
+    except (AttributeError, OSError):
+        return None
+    return (bytes(archive_footer), st.st_size, st.st_mtime_ns)
+
+def load_index_cache(path, key):
+    """ Returns an IndexCache if there's a valid one at path for the given key, otherwise None. """
+    try:
+        with open(path, "rb") as f:
+            mapping = map_file(f)
+    except OSError:
+        return None
+    if mapping == None: return None
+    buffer = memoryview(mapping)
+
+    archive_footer, archive_size, archive_mtime_ns = key
+    try:
+        (
+            signature,
+            found_archive_footer,
+            found_archive_size,
+            found_archive_mtime_ns,
+            item_count,
+            names_size,
+            slot_count,
+            crc32,
+        ) = _header.unpack_from(buffer)
+        if (signature, found_archive_footer, found_archive_size, found_archive_mtime_ns) != (index_cache_signature, archive_footer, archive_size, archive_mtime_ns):
+            # Stale.
+            raise ValueError
+        if slot_count == 0 or slot_count & (slot_count - 1) != 0: raise ValueError
+        if len(buffer) != _header.size + item_count * _record.size + names_size + slot_count * 8: raise ValueError
+        # Damaged, such as by a crash while the filesystem was writing it out.
+        if zlib.crc32(buffer[_header.size:]) != crc32: raise ValueError
+    except (ValueError, struct.error):
+        release_buffer(buffer)
+        return None
+    return IndexCache(buffer, item_count, names_size, slot_count)
+
+def write_index_cache(path, key, records):
+    """
+    records is a list in the format of IndexCache.record().
+    The file is written under a temporary name and then renamed into place.
+    """
+    archive_footer, archive_size, archive_mtime_ns = key
+    slot_count = 1 << (2 * len(records)).bit_length()
+    mask = slot_count - 1
+    slots = array("Q", bytes(8 * slot_count))
+
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as f:
+            # Rewritten with the sizes and crc32 at the end.
+            f.write(bytes(_header.size))
+            crc32 = 0
+            def write(buf):
+                nonlocal crc32
+                crc32 = zlib.crc32(buf, crc32)
+                f.write(buf)
+
+            name_offset = 0
+            for i, (jump_location, file_size, file_type, name, contents_crc32, stream_start, skip_bytes_until_contents) in enumerate(records):
+                write(_record.pack(
+                    jump_location,
+                    file_size,
+                    stream_start,
+                    skip_bytes_until_contents,
+                    name_offset,
+                    contents_crc32,
+                    (file_type << 14) | len(name),
+                ))
+                name_offset += len(name)
+
+                # Trust the first item with any given name.
+                slot = zlib.crc32(name) & mask
+                while slots[slot] != 0:
+                    if records[slots[slot] - 1][3] == name: break
+                    slot = (slot + 1) & mask
+                else:
+                    slots[slot] = i + 1
+
+            for record in records:
+                write(record[3])
+            if sys.byteorder != "little": slots.byteswap()
+            write(slots)
+
+            f.seek(0)
+            f.write(_header.pack(index_cache_signature, archive_footer, archive_size, archive_mtime_ns, len(records), name_offset, slot_count, crc32))
+        os.replace(tmp_path, path)
+    except:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
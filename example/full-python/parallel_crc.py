@@ -0,0 +1,112 @@
+import zlib
+import functools
+
+def _load_native_crc32_combine():
+    """ Returns zlib's own crc32_combine through ctypes, or None if it can't be found. """
+    try:
+        import ctypes, ctypes.util
+        path = ctypes.util.find_library("z")
+        if path == None: return None
+        combine = ctypes.CDLL(path).crc32_combine64
+    except (ImportError, OSError, AttributeError):
+        return None
+    combine.restype = ctypes.c_ulong
+    combine.argtypes = [ctypes.c_ulong, ctypes.c_ulong, ctypes.c_int64]
+    return combine
+
+_native_crc32_combine = _load_native_crc32_combine()
+
+def crc32_combine(crc1, crc2, len2):
+    """
+    Returns the crc32 of A + B given crc1 = zlib.crc32(A), crc2 = zlib.crc32(B), and len2 = len(B).
+    Uses zlib's implementation if the shared library can be loaded, otherwise crc32_combine_python().
+    """
+    if _native_crc32_combine != None:
+        return _native_crc32_combine(crc1, crc2, len2)
+    return crc32_combine_python(crc1, crc2, len2)
+
+def crc32_combine_python(crc1, crc2, len2):
+    """ Like crc32_combine(), but always in pure Python. """
+    if len2 == 0: return crc1
+    return _gf2_matrix_times(_zeros_operator(len2), crc1) ^ crc2
+
+# Anything at least this large is read once by crc32_both() and the second crc32 is combined instead.
+crc32_both_threshold = 0x4000
+
+def crc32_both(buf, value1, value2):
+    """ Returns (zlib.crc32(buf, value1), zlib.crc32(buf, value2)), reading a large buf only once. """
+    if len(buf) < crc32_both_threshold:
+        return zlib.crc32(buf, value1), zlib.crc32(buf, value2)
+    crc = zlib.crc32(buf)
+    return crc32_combine(value1, crc, len(buf)), crc32_combine(value2, crc, len(buf))
+
+# A crc32 register is a vector over GF(2), and appending zero bytes is a linear operator on it,
+# represented as a list of 32 columns. See crc32_combine() in zlib.
+
+def _gf2_matrix_times(matrix, vector):
+    result = 0
+    i = 0
+    while vector != 0:
+        if vector & 1: result ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return result
+
+def _gf2_matrix_product(a, b):
+    return [_gf2_matrix_times(a, column) for column in b]
+
+@functools.lru_cache(maxsize=64)
+def _zeros_operator(length):
+    """ Returns the operator that appends length zero bytes to a crc32 register. """
+    # One zero bit: shift right, and xor the polynomial in when the low bit falls off.
+    operator = [0xEDB88320] + [1 << n for n in range(31)]
+    # One zero byte.
+    for _ in range(3):
+        operator = _gf2_matrix_product(operator, operator)
+    result = None
+    while True:
+        if length & 1:
+            result = operator if result == None else _gf2_matrix_product(operator, result)
+        length >>= 1
+        if length == 0: return result
+        operator = _gf2_matrix_product(operator, operator)
+
+class ParallelCrc32:
+    """
+    Computes crc32s of large buffers with a pool of threads,
+    merging the results for each piece with crc32_combine().
+    zlib.crc32 releases the GIL for large buffers, so the pieces really are computed in parallel.
+    """
+    def __init__(self, jobs, piece_size=0x100000):
+        from concurrent.futures import ThreadPoolExecutor
+        self._executor = ThreadPoolExecutor(jobs)
+        self.piece_size = piece_size
+
+    def __enter__(self): return self
+    def __exit__(self, *args): self.close()
+
+    def crc32(self, data, value=0):
+        """ Like zlib.crc32(data, value). """
+        with memoryview(data) as view, view.cast("B") as view:
+            if len(view) < 2 * self.piece_size: return zlib.crc32(view, value)
+            pieces = [view[i:i + self.piece_size] for i in range(0, len(view), self.piece_size)]
+            for piece, crc in zip(pieces, self._executor.map(zlib.crc32, pieces)):
+                value = crc32_combine(value, crc, len(piece))
+            return value
+
+    def chunk_crc32s(self, data, chunk_size):
+        """ Returns a list of the zlib.crc32 of each chunk_size slice of data, the last of which may be shorter. """
+        with memoryview(data) as view, view.cast("B") as view:
+            # Each job handles whole chunks.
+            piece_size = max(1, self.piece_size // chunk_size) * chunk_size
+            pieces = [view[i:i + piece_size] for i in range(0, len(view), piece_size)]
+            crcs = []
+            for piece_crcs in self._executor.map(functools.partial(_chunk_crc32s, chunk_size=chunk_size), pieces):
+                crcs.extend(piece_crcs)
+            return crcs
+
+    def close(self):
+        self._executor.shutdown()
+
+def _chunk_crc32s(view, chunk_size):
+    return [zlib.crc32(view[i:i + chunk_size]) for i in range(0, len(view), chunk_size)]
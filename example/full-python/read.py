@@ -1,17 +1,30 @@
 #!/usr/bin/env python3
 
 import sys, os
+import errno
 import struct
 import zlib
 import tempfile
+import threading
+import io
+import queue
+import contextlib
+from collections import OrderedDict
+import itertools
+from array import array
 
 from common import *
-from file_slice import FileSlice
+from file_slice import FileSlice, BufferSlice, map_file, release_buffer
+from checkpoint_cache import CheckpointCache
+from index_cache import cache_key, load_index_cache, write_index_cache
+from read_ahead import ReadAheadFile
+from parallel_crc import crc32_both
 
 def main():
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("archive")
+    parser.add_argument("archive", help=
+        "Path to the archive, or '-' for stdin, which may be a pipe.")
     parser.add_argument("-x", "--extract", metavar="DIR", help=
         "Extract entire archive to the given directory.")
     parser.add_argument("--no-streaming-fallback", help=
@@ -21,18 +34,61 @@ def main():
     parser.add_argument("--no-validate-index", action="store_true", help=
         "Normally when extracting all items, the index will be validated to guard against ambiguous archives. "
         "Passing this option stops reading the archive after the Data Region.")
+    parser.add_argument("--index-cache", action="store_true", help=
+        "Cache the parsed index in a sidecar file named after the archive with an extra '.idx' extension, "
+        "and use it on later runs if the archive hasn't changed.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help=
+        "When extracting, use the index to extract this many compression streams at a time in parallel. "
+        "Falls back to extracting sequentially if the archive does not support seeking.")
+    parser.add_argument("--pipeline", action="store_true", help=
+        "When extracting all items, use a streaming read that validates the index, "
+        "with a background thread reading the archive ahead and --jobs threads creating and writing files. "
+        "This is the default with --jobs above 1 when the archive does not support seeking.")
+    parser.add_argument("--verify", action="store_true", help=
+        "Check the integrity of every item without writing anything. "
+        "With an index, the compression streams are inflated --jobs at a time in parallel; "
+        "otherwise this is a streaming read that validates the index.")
     parser.add_argument("items", nargs="*", help=
         "If specified, only extracts the given items.")
-    args = parser.parse_args()
+    args = parser.parse_intermixed_args()
+
+    if args.verify:
+        if args.extract or args.items: parser.error("--verify does not take --extract or items")
+        verify(args.archive, args.jobs, args.no_streaming_fallback)
+        return
 
     want_every_item = not args.items
     want_contents = bool(args.extract)
-    prefer_index = not want_every_item or not want_contents
+    prefer_index = not want_every_item or not want_contents or args.jobs > 1
+    pipeline = want_every_item and want_contents and args.pipeline
+    if pipeline: prefer_index = False
 
     specific_items = set(args.items)
     found_items = set()
-    with open_path(args.archive, prefer_index, args.no_streaming_fallback, not args.no_validate_index) as reader:
-        for item in reader:
+    index_cache_path = args.archive + ".idx" if args.index_cache and args.archive != "-" else None
+    if args.archive == "-":
+        # Unbuffered, such that closing it never waits for the read-ahead thread.
+        reader = reader_for_file(open(sys.stdin.fileno(), "rb", buffering=0, closefd=False), prefer_index, args.no_streaming_fallback, not args.no_validate_index)
+    else:
+        reader = open_path(args.archive, prefer_index, args.no_streaming_fallback, not args.no_validate_index, index_cache_path=index_cache_path, read_ahead=pipeline)
+    # Only used when extracting. Nothing is opened until then.
+    with reader, DirectoryCache(args.extract) as directories:
+        if want_every_item and want_contents and isinstance(reader, StreamingReader) and (pipeline or args.jobs > 1):
+            extract_items_pipelined(args.extract, reader, args.jobs)
+            return
+        # Parallel extraction reopens the archive for each thread.
+        parallel = args.extract and args.jobs > 1 and isinstance(reader, IndexReader) and args.archive != "-"
+        parallel_items = []
+        # name -> file_type of the first item with that name.
+        parallel_names = {}
+        # Every item in order, when we see them all anyway.
+        all_items = [] if parallel and len(specific_items) == 0 else None
+        items = reader
+        if len(specific_items) > 0 and isinstance(reader, IndexReader):
+            # Look up just the requested items, and then handle them in archive order.
+            items = [reader.get(name) for name in specific_items]
+            items = sorted((item for item in items if item != None), key=lambda item: (item._stream_start, item._skip_bytes_until_contents))
+        for item in items:
             if len(specific_items) == 0:
                 # Handle every item.
                 pass
@@ -44,15 +100,28 @@ def main():
                 reader.skip_item(item)
                 continue
 
-            if args.extract:
+            if parallel:
+                # Extract later.
+                if all_items != None: all_items.append(item)
+                first_file_type = parallel_names.get(item.file_name_str)
+                if first_file_type == None:
+                    parallel_names[item.file_name_str] = item.file_type
+                    parallel_items.append(item)
+                elif not first_file_type == item.file_type == FILE_TYPE_DIRECTORY:
+                    # Reject the collision, like _create_file() does when extracting sequentially.
+                    raise FileExistsError(errno.EEXIST, "duplicate name in archive", os.path.join(args.extract, item.file_name_str))
+            elif args.extract:
                 # Extract.
                 reader.open_item(item)
-                extract_item(args.extract, reader, item)
+                extract_item(directories, reader, item)
             else:
                 # Just list.
                 reader.skip_item(item)
                 print(item.file_name_str)
 
+    if parallel:
+        extract_items_parallel(args.archive, args.extract, parallel_items, args.jobs, all_items)
+
     missing_items = specific_items - found_items
     if len(missing_items) > 0:
         sys.exit("\n".join([
@@ -60,59 +129,534 @@ def main():
             for name in sorted(missing_items)
         ]))
 
-def extract_item(dir, reader, item):
-    # Implicit ancestors directories
-    i = item.file_name_str.find("/")
-    while i != -1:
-        ancestor = item.file_name_str[:i]
-        i = item.file_name_str.find("/", i)
-        ancestor_dir = os.path.join(dir, ancestor.replace("/", os.path.sep))
-        if not os.path.isdir(ancestor_dir):
-            os.mkdir(ancestor_dir) # an error here means this is already a file or symlink.
-
-    # File contents
-    file_name_path = os.path.join(dir, item.file_name_str.replace("/", os.path.sep))
+def extract_items_parallel(archive_path, dir, items, jobs, all_items=None):
+    """
+    Extracts the given IndexItems with a pool of threads.
+    Every compression stream containing any of them is inflated in full and verified like verify_streams_parallel(),
+    so a mismatch with the index fails the extraction just like a streaming read would.
+    Each stream is handled by one thread, which has its own file handle, IndexReader, and DirectoryCache.
+    all_items is every IndexItem of the archive in order, if the caller already has them; otherwise the Index Region is parsed again.
+    """
+    if all_items == None:
+        with open_path(archive_path, require_index=True) as reader:
+            all_items = list(reader._parse_index())
+    wanted = {(item._stream_start, item._skip_bytes_until_contents) for item in items}
+    streams = [stream for stream in _streams(all_items) if any((item._stream_start, item._skip_bytes_until_contents) in wanted for item in stream[2])]
+
+    def extract_stream(reader, directories, stream):
+        stream_start, stream_end, items, next_item = stream
+        if stream_end == None: stream_end = reader.index_location
+        _verify_stream(reader, stream_start, stream_end, items, next_item, bytearray(0xFFFF), _StreamExtractor(directories, wanted))
+
+    _run_parallel(archive_path, streams, jobs, extract_stream, lambda: DirectoryCache(dir))
+
+class _StreamExtractor:
+    """ For _verify_stream(), extracts the wanted items as their stream is verified. """
+    def __init__(self, directories, wanted):
+        self._directories = directories
+        # (_stream_start, _skip_bytes_until_contents) of each item to extract.
+        self._wanted = wanted
+
+    def open(self, item):
+        """ Returns a file to write the contents of the item to, or None. """
+        if item.file_type in (FILE_TYPE_DIRECTORY, FILE_TYPE_SYMLINK) or not self._is_wanted(item): return None
+        return _create_file(self._directories, item)
+
+    def finish(self, item, output):
+        """ Called once the item is verified, before output is closed. """
+        if not self._is_wanted(item): return
+        if output == None:
+            extract_item(self._directories, None, item)
+        else:
+            _chmod_if_executable(output, item)
+
+    def _is_wanted(self, item):
+        return (item._stream_start, item._skip_bytes_until_contents) in self._wanted
+
+def _run_parallel(archive_path, work, jobs, process, open_context):
+    """
+    Calls process(reader, context, x) for each x in work with a pool of threads.
+    Each thread has its own file handle and IndexReader of the archive, and its own context from the context manager open_context().
+    After the first failure, the other threads stop taking work, and the error is raised.
+    zlib releases the GIL while inflating, so the streams really are decompressed in parallel.
+    """
+    work = iter(work)
+    lock = threading.Lock()
+    failed = False
+
+    def worker():
+        nonlocal failed
+        try:
+            with open_path(archive_path, require_index=True) as reader, open_context() as context:
+                while True:
+                    with lock:
+                        x = None if failed else next(work, None)
+                    if x == None: break
+                    process(reader, context, x)
+        except:
+            # Tell everyone else to stop.
+            failed = True
+            raise
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(jobs) as executor:
+        futures = [executor.submit(worker) for _ in range(jobs)]
+    for future in futures:
+        future.result()
+
+def verify(archive_path, jobs=1, require_index=False):
+    """
+    Checks the integrity of the whole archive without extracting anything, raising MalformedInputError on the first problem found.
+    Uses verify_streams_parallel() if the archive has an index and supports seeking,
+    otherwise a StreamingReader pass, which validates the index.
+    """
+    if archive_path == "-":
+        reader = reader_for_file(open(sys.stdin.fileno(), "rb", buffering=0, closefd=False), prefer_index=False, require_index=require_index)
+    else:
+        reader = open_path(archive_path, require_index=require_index)
+    with reader:
+        if isinstance(reader, IndexReader):
+            # Parsing the whole index checks the index_crc32.
+            items = list(reader._parse_index())
+        else:
+            for item in reader:
+                reader.skip_item(item)
+            return
+    verify_streams_parallel(archive_path, items, jobs)
+
+def verify_streams_parallel(archive_path, items, jobs):
+    """
+    Inflates every compression stream of the Data Region with a pool of threads, given every IndexItem of the archive in order.
+    Each item's DataItem header, chunk sizes, streaming_crc32, and contents_crc32 are checked against the index,
+    and every stream has to end exactly where the next jump_location (or the Index Region) says it does.
+    """
+    def verify_stream(reader, buffer, stream):
+        stream_start, stream_end, items, next_item = stream
+        if stream_end == None: stream_end = reader.index_location
+        _verify_stream(reader, stream_start, stream_end, items, next_item, buffer)
+
+    _run_parallel(archive_path, _streams(items), jobs, verify_stream, lambda: contextlib.nullcontext(bytearray(0xFFFF)))
+
+def _streams(items):
+    """
+    Given every IndexItem of the archive in order, returns the compression streams of the Data Region as
+    (stream_start, stream_end, items whose contents are in the stream, first item of the next stream or None),
+    where stream_end is None for the last stream, which ends at the index_location.
+    """
+    # [stream_start, items whose contents are in the stream]
+    data_region_start = 4
+    stream_items = [[data_region_start, []]]
+    for item in items:
+        if item.jump_location != 0: stream_items.append([item.jump_location, []])
+        stream_items[-1][1].append(item)
+    streams = []
+    for k, (stream_start, contents_items) in enumerate(stream_items):
+        if k + 1 < len(stream_items):
+            streams.append((stream_start, stream_items[k + 1][0], contents_items, stream_items[k + 1][1][0]))
+        else:
+            streams.append((stream_start, None, contents_items, None))
+    return streams
+
+def _verify_stream(reader, stream_start, stream_end, items, next_item, buffer, extractor=None):
+    """ Also extracts items along the way if given a _StreamExtractor. """
+    if not (stream_start < stream_end <= reader.index_location): raise MalformedInputError("jump_location out of order")
+    contents_file = reader._slice(stream_start, stream_end)
+    cursor = _StreamCursor(stream_start, contents_file)
+    data_region_start = 4
+    for i, item in enumerate(items):
+        # The DataItem header of the first item in a stream is at the end of the previous stream.
+        if i > 0 or stream_start == data_region_start:
+            _verify_data_item_header(cursor, item)
+        output = extractor.open(item) if extractor != None else None
+        try:
+            _verify_item_contents(cursor, item, buffer, output)
+            if extractor != None: extractor.finish(item, output)
+        finally:
+            if output != None: output.close()
+    if next_item != None:
+        _verify_data_item_header(cursor, next_item)
+
+    # Make sure the stream ends exactly at the next jump_location.
+    decompressor = cursor._decompressor
+    if len(_read_from_decompressor(decompressor, contents_file, 1, allow_eof=True)) != 0:
+        raise MalformedInputError("compression stream at {} continues past the next jump_location".format(stream_start))
+    if len(decompressor.unused_data) != 0 or contents_file.start != contents_file.end:
+        raise MalformedInputError("compression stream at {} ends before the next jump_location".format(stream_start))
+
+def _verify_item_contents(cursor, item, buffer, output):
+    """ Verifies the item's chunked contents and streaming_crc32, writing the contents to output if it's not None. """
+    streaming_crc32 = zlib.crc32(_data_item_header(item))
+    contents_crc32 = 0
+    remaining_bytes = item.file_size
+    while True:
+        size = min(remaining_bytes, 0xFFFF)
+        chunk_size_buf = cursor.read(2)
+        if struct.unpack("<H", chunk_size_buf)[0] != size: raise MalformedInputError("file_size does not match the contents of: " + item.file_name_str)
+        view = memoryview(buffer)[:size]
+        cursor.readinto(view)
+        if output != None: output.write(view)
+        streaming_crc32 = zlib.crc32(chunk_size_buf, streaming_crc32)
+        streaming_crc32, contents_crc32 = crc32_both(view, streaming_crc32, contents_crc32)
+        remaining_bytes -= size
+        if size < 0xFFFF: break
+    if item.file_type in (FILE_TYPE_DIRECTORY, FILE_TYPE_SYMLINK):
+        _check_special_contents(item, bytes(view))
+
+    (documented_streaming_crc32,) = struct.unpack("<L", cursor.read(4))
+    if streaming_crc32 != documented_streaming_crc32:
+        raise MalformedInputError("streaming_crc32 check failed for {}. calculated: {}, documented: {}".format(item.file_name_str, streaming_crc32, documented_streaming_crc32))
+    if contents_crc32 != item.contents_crc32:
+        raise MalformedInputError("contents_crc32 check failed for {}. calculated: {}, documented: {}".format(item.file_name_str, contents_crc32, item.contents_crc32))
+
+def _verify_data_item_header(cursor, item):
+    header = _data_item_header(item)
+    if cursor.read(len(header)) != header: raise MalformedInputError("DataItem does not match the index: " + item.file_name_str)
+
+def _data_item_header(item):
+    name = item.file_name_str.encode("utf8")
+    return streaming_signature + struct.pack("<H", (item.file_type << 14) | len(name)) + name
+
+def extract_items_pipelined(dir, reader, jobs):
+    """
+    Extracts every item from a StreamingReader, which inflates and validates on this thread,
+    while a pool of threads creates and writes the files, such that file creation latency doesn't stall reading.
+    All the work for any given name goes to the same thread, so duplicate names are handled in archive order.
+    """
+    workers = [_ExtractWorker(dir) for _ in range(jobs)]
+    try:
+        for item in reader:
+            worker = workers[hash(item.file_name_str) % jobs]
+            if item.file_type in (FILE_TYPE_DIRECTORY, FILE_TYPE_SYMLINK):
+                worker.put((item, None))
+            else:
+                while True:
+                    buf = reader.read_from_item(item)
+                    worker.put((item, buf))
+                    if item.done: break
+        for worker in workers:
+            worker.flush()
+    finally:
+        for worker in workers:
+            worker.finish()
+    for worker in workers:
+        worker.raise_error()
+
+class _ExtractWorker:
+    """
+    A thread that extracts items given to it as a sequence of (item, contents_chunk).
+    A regular file ends with the chunk after which item.done is True.
+    """
+    def __init__(self, dir):
+        self._dir = dir
+        # Work is handed over in batches, because each handoff between threads costs a lot more than a small item.
+        self._batch = []
+        self._batch_size = 0
+        self._queue = queue.Queue(maxsize=16)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def put(self, work):
+        self._batch.append(work)
+        self._batch_size += 0x1000 if work[1] == None else 0x1000 + len(work[1])
+        if self._batch_size >= 0x100000: self.flush()
+
+    def flush(self):
+        if self._error != None: raise self._error
+        if len(self._batch) == 0: return
+        self._queue.put(self._batch)
+        self._batch = []
+        self._batch_size = 0
+
+    def finish(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def raise_error(self):
+        if self._error != None: raise self._error
+
+    def _run(self):
+        with DirectoryCache(self._dir) as directories:
+            self._extract(directories)
+
+    def _extract(self, directories):
+        output = None
+        output_item = None
+        for item, buf in self._work():
+            if self._error != None:
+                # Keep draining the queue so the reader doesn't block.
+                continue
+            try:
+                if item.file_type in (FILE_TYPE_DIRECTORY, FILE_TYPE_SYMLINK):
+                    extract_item(directories, None, item)
+                    continue
+                if output_item != item:
+                    output_item = item
+                    output = _create_file(directories, item)
+                output.write(buf)
+                # Note that item.done may be True already by the time we see earlier chunks.
+                if len(buf) < 0xFFFF:
+                    _chmod_if_executable(output, item)
+                    output.close()
+                    output = None
+                    output_item = None
+            except BaseException as e:
+                self._error = e
+                if output != None: output.close()
+                output = None
+        # The work ended in the middle of a file, such as when the reader failed.
+        if output != None: output.close()
+
+    def _work(self):
+        while True:
+            batch = self._queue.get()
+            if batch == None: return
+            yield from batch
+
+def extract_item(directories, reader, item):
+    """ directories is a DirectoryCache for the extraction directory. """
     if item.file_type == FILE_TYPE_DIRECTORY:
-        if not os.path.isdir(file_name_path):
-            os.mkdir(file_name_path) # an error here means this is already a file or symlink.
+        directories.directory(item.file_name_str)
     elif item.file_type == FILE_TYPE_SYMLINK:
         # Validation has already been done on the symlink target via validate_archive_path().
-        os.symlink(item.symlink_target, file_name_path)
+        dir_fd, path = directories.parent(item.file_name_str)
+        os.symlink(item.symlink_target, path, dir_fd=dir_fd)
     else:
         # Pump contents of regular file.
-        with open(file_name_path, "wb") as output:
+        with _create_file(directories, item) as output:
             while not item.done:
                 output.write(reader.read_from_item(item))
-        if item.file_type == FILE_TYPE_POSIX_EXECUTABLE:
-            # chmod posix executable bits.
-            mode = os.stat(file_name_path).st_mode
-            # Respect whatever umask limited the permissions on create.
-            # Only eneable x where r is already enabled.
-            mode |= (mode & 0o444) >> 2
-            os.chmod(file_name_path, mode)
-
-def open_path(archive_path, prefer_index=True, require_index=False, validate_index=True):
-    file = open(archive_path, "rb")
+            _chmod_if_executable(output, item)
+
+def _create_file(directories, item):
+    """
+    Creates the ancestors and the regular file for the given item, and returns it open for writing.
+    Fails if anything already has the item's name, such as an earlier item with a colliding name.
+    """
+    dir_fd, path = directories.parent(item.file_name_str)
+    return open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666, dir_fd=dir_fd), "wb")
+
+def _chmod_if_executable(file, item):
+    if item.file_type == FILE_TYPE_POSIX_EXECUTABLE and os.chmod in os.supports_fd:
+        # chmod posix executable bits.
+        mode = os.fstat(file.fileno()).st_mode
+        # Respect whatever umask limited the permissions on create.
+        # Only eneable x where r is already enabled.
+        mode |= (mode & 0o444) >> 2
+        os.chmod(file.fileno(), mode)
+
+# Whether DirectoryCache can hold directory file descriptors.
+_use_dir_fd = hasattr(os, "O_DIRECTORY") and all(f in os.supports_dir_fd for f in (os.open, os.mkdir, os.symlink))
+
+class DirectoryCache:
+    """
+    Creates directories under an extraction directory as needed, and keeps the most recently used ones open,
+    such that items are created relative to their parent directory rather than resolving every ancestor again.
+    Directories are held as file descriptors where the platform supports dir_fd, otherwise as paths.
+    Nothing is opened until it's needed.
+    Not thread-safe; give each thread its own.
+    """
+    def __init__(self, dir, max_open=64):
+        self._dir = dir
+        self._max_open = max_open
+        self._root = None
+        # archive path of a directory -> (dir_fd, prefix). See directory().
+        self._open = OrderedDict()
+
+    def __enter__(self): return self
+    def __exit__(self, *args): self.close()
+
+    def parent(self, name):
+        """
+        Creates the ancestors of the given archive path if necessary.
+        Returns (dir_fd, path) to create the item with, such as os.open(path, ..., dir_fd=dir_fd).
+        """
+        parent, _, base_name = name.rpartition("/")
+        dir_fd, prefix = self.directory(parent)
+        return dir_fd, prefix + base_name
+
+    def directory(self, name):
+        """
+        Creates the directory at the given archive path and its ancestors if necessary.
+        The empty string is the extraction directory itself.
+        Returns (dir_fd, prefix), where dir_fd is None or prefix is empty, to create things in the directory with.
+        """
+        if name == "":
+            if self._root == None:
+                if _use_dir_fd:
+                    self._root = (os.open(self._dir, os.O_RDONLY | os.O_DIRECTORY), "")
+                else:
+                    self._root = (None, os.path.join(self._dir, ""))
+            return self._root
+
+        found = self._open.get(name)
+        if found != None:
+            self._open.move_to_end(name)
+            return found
+
+        dir_fd, path = self.parent(name)
+        try:
+            os.mkdir(path, dir_fd=dir_fd)
+        except FileExistsError:
+            # Another item or thread might have created it already.
+            # Otherwise, this is already a file or a symlink, and opening it as a directory fails below.
+            pass
+        if _use_dir_fd:
+            # Never follow a symlink, such as one extracted from the archive pointing anywhere else.
+            found = (os.open(path, os.O_RDONLY | os.O_DIRECTORY | getattr(os, "O_NOFOLLOW", 0), dir_fd=dir_fd), "")
+        else:
+            if os.path.islink(path) or not os.path.isdir(path): raise NotADirectoryError(path)
+            found = (None, os.path.join(path, ""))
+
+        self._open[name] = found
+        if len(self._open) > self._max_open:
+            _, (evicted_dir_fd, _) = self._open.popitem(last=False)
+            if evicted_dir_fd != None: os.close(evicted_dir_fd)
+        return found
+
+    def close(self):
+        for dir_fd, _ in list(self._open.values()) + ([self._root] if self._root != None else []):
+            if dir_fd != None: os.close(dir_fd)
+        self._open.clear()
+        self._root = None
+
+def open_path(archive_path, prefer_index=True, require_index=False, validate_index=True, checkpoint_cache=None, index_cache_path=None, read_ahead=False):
+    """
+    With read_ahead=True, the archive is read on a background thread, which means a streaming read.
+    """
+    if read_ahead:
+        file = ReadAheadFile(open(archive_path, "rb", buffering=0))
+    else:
+        file = open(archive_path, "rb")
     try:
-        return reader_for_file(file, prefer_index, require_index, validate_index)
+        return reader_for_file(file, prefer_index, require_index, validate_index, checkpoint_cache, index_cache_path)
     except:
         file.close()
         raise
-def reader_for_file(file, prefer_index=True, require_index=False, validate_index=True):
+def reader_for_file(file, prefer_index=True, require_index=False, validate_index=True, checkpoint_cache=None, index_cache_path=None):
+    """
+    file is either a binary file-like object or a bytes-like object containing the entire archive.
+    Regular files are memory-mapped when possible.
+    index_cache_path is an optional sidecar file for IndexReader to cache the parsed Index Region in.
+    """
     if not prefer_index: require_index = False
-    # ArchiveHeader
-    if file.read(4) != archive_header: raise MalformedInputError("not a poaf archive")
+    if isinstance(file, (bytes, bytearray, memoryview)):
+        file, buffer = None, file
+        seekable = True
+        # ArchiveHeader
+        if bytes(buffer[:4]) != archive_header: raise MalformedInputError("not a poaf archive")
+    else:
+        seekable = file.seekable()
+        if require_index and not seekable:
+            raise IncompatibleInputError("archive file does not support seeking")
+        if not seekable and _has_fileno(file) and not isinstance(file, ReadAheadFile):
+            # Overlap slow reads from pipes and sockets with inflation.
+            file = ReadAheadFile(file)
+        try:
+            # ArchiveHeader
+            if file.read(4) != archive_header: raise MalformedInputError("not a poaf archive")
+        except:
+            if not seekable: file.close()
+            raise
+        buffer = map_file(file) if seekable else None
 
-    seekable = file.seekable()
-    if require_index and not seekable:
-        raise IncompatibleInputError("archive file does not support seeking")
+    try:
+        if prefer_index and seekable:
+            return IndexReader(file, checkpoint_cache, buffer=buffer, index_cache_path=index_cache_path)
+        else:
+            return StreamingReader(file, validate_index=validate_index, buffer=buffer)
+    except:
+        if buffer != None:
+            release_buffer(memoryview(buffer))
+        raise
 
-    if prefer_index and seekable:
-        return IndexReader(file)
-    else:
-        return StreamingReader(file, validate_index=validate_index)
+def _has_fileno(file):
+    try:
+        file.fileno()
+    except (AttributeError, OSError, ValueError):
+        return False
+    return True
 
 default_chunk_size = 0x4000
+# How much StreamingReader decompresses at a time.
+stream_output_block_size = 0x40000
+# For reading compressed input when we expect to inflate a lot of it.
+large_chunk_size = 0x10000
+
+# The IndexItem fields before the name.
+_index_item_struct = struct.Struct("<QQLH")
+# A 32-bit array typecode.
+_uint32 = "I" if array("I").itemsize == 4 else "L"
+# How much memory StreamingReader spends remembering the IndexItems it expects to find before spilling them to a tmpfile.
+predicted_index_memory_budget = 0x4000000
+# How many IndexItems StreamingReader compares at a time.
+predicted_index_batch_size = 0x1000
+
+class _PredictedIndex:
+    """
+    IndexItems in columns: jump_locations, file_sizes, contents_crc32s, and type_and_name_sizes are arrays,
+    names is all the names concatenated, and name_ends is the end offset of each name in names.
+    Above the memory budget, the columns so far are spilled to a tmpfile as a segment and the next segment starts empty.
+    """
+    def __init__(self, memory_budget=None):
+        self._memory_budget = memory_budget
+        self._tmpfile = None
+        # (item count, size of names) for each spilled segment.
+        self._spilled_segments = []
+        self._new_segment()
+
+    def _new_segment(self):
+        self.jump_locations = array("Q")
+        self.file_sizes = array("Q")
+        self.contents_crc32s = array(_uint32)
+        self.type_and_name_sizes = array("H")
+        self.name_ends = array("Q")
+        self.names = bytearray()
+
+    def _columns(self):
+        return (self.jump_locations, self.file_sizes, self.contents_crc32s, self.type_and_name_sizes, self.name_ends)
+
+    def append(self, jump_location, file_size, contents_crc32, type_and_name_size, name):
+        self.jump_locations.append(jump_location)
+        self.file_sizes.append(file_size)
+        self.contents_crc32s.append(contents_crc32)
+        self.type_and_name_sizes.append(type_and_name_size)
+        self.names += name
+        self.name_ends.append(len(self.names))
+        memory_budget = predicted_index_memory_budget if self._memory_budget == None else self._memory_budget
+        if len(self.jump_locations) * 30 + len(self.names) > memory_budget:
+            self._spill()
+
+    def _spill(self):
+        if self._tmpfile == None:
+            self._tmpfile = tempfile.TemporaryFile()
+        for column in self._columns():
+            column.tofile(self._tmpfile)
+        self._tmpfile.write(self.names)
+        self._spilled_segments.append((len(self.jump_locations), len(self.names)))
+        self._new_segment()
+
+    def segments(self):
+        """
+        Generates (jump_locations, file_sizes, contents_crc32s, type_and_name_sizes, name_ends, names) for each segment in order,
+        reading spilled segments back one at a time.
+        """
+        if self._tmpfile != None:
+            self._tmpfile.seek(0)
+        for count, names_size in self._spilled_segments:
+            columns = []
+            for typecode in ("Q", "Q", _uint32, "H", "Q"):
+                column = array(typecode)
+                column.fromfile(self._tmpfile, count)
+                columns.append(column)
+            names = self._tmpfile.read(names_size)
+            assert len(names) == names_size, "tmpfile modified mid-operation?"
+            yield tuple(columns) + (names,)
+        yield self._columns() + (self.names,)
+
+    def close(self):
+        if self._tmpfile != None:
+            self._tmpfile.close()
 
 class BaseReader:
     def __enter__(self): return self
@@ -127,14 +671,22 @@ class BaseReader:
     def skip_item(self, item): pass
 
 class StreamingReader(BaseReader):
-    def __init__(self, file, validate_index=True):
-        self._input = file
+    def __init__(self, file, validate_index=True, buffer=None):
+        # Read through a memoryview of the whole archive when we have one.
+        self._file = file
+        self._buffer = memoryview(buffer) if buffer != None else None
+        self._input = BufferSlice(self._buffer, 4, len(self._buffer)) if buffer != None else file
         self.validating_index = validate_index
 
         self._decompressor = Decompressor()
+        # Decompressed output is buffered in large blocks, and fields are sliced out of it.
+        # This never holds data from more than one compression stream.
+        self._output = b""
+        self._output_position = 0
+        # Input to feed a new decompressor before reading more from the file.
+        self._pending_input = None
         if self.validating_index:
-            self._index_tmpfile = tempfile.TemporaryFile()
-            self._index_crc32 = 0
+            self._predicted_index = _PredictedIndex()
 
         self._current_item = None
 
@@ -142,9 +694,9 @@ class StreamingReader(BaseReader):
         self._decompressor = None
         try:
             if self.validating_index:
-                self._index_tmpfile.close()
+                self._predicted_index.close()
         finally:
-            self._input.close()
+            _close_input(self._file, self._buffer)
 
     def next(self):
         if self._current_item != None: raise ValueError("use skip_item() or call read_from_item() until done")
@@ -197,27 +749,15 @@ class StreamingReader(BaseReader):
         item.done = len(buf) < 0xFFFF
 
         # Special handling for directory and symlink contents.
-        if item.file_type == FILE_TYPE_DIRECTORY:
-            if chunk_size > 0: raise MalformedInputError("directory items must have 0-length contents")
-        elif item.file_type == FILE_TYPE_SYMLINK:
-            if chunk_size > 4095: raise MalformedInputError("symlink length exceeds 4095")
-            try:
-                item.symlink_target = buf.decode("utf8")
-            except UnicodeDecodeError as e:
-                raise MalformedInputError("symlink target invalid utf8: " + str(e))
-            try:
-                validate_archive_path(item.symlink_target, file_name_of_symlink=item.file_name_str)
-            except InvalidArchivePathError as e:
-                raise MalformedInputError("illegal symlink target: " + str(e))
+        _check_special_contents(item, buf)
 
         # Track file size
         item._predicted_index_item.file_size += len(buf)
         if item._predicted_index_item.file_size > size_limit: raise ItemContentsTooLongError
 
         # Compute crc32
-        item.streaming_crc32                      = zlib.crc32(chunk_size_buf, item.streaming_crc32)
-        item.streaming_crc32                      = zlib.crc32(buf,            item.streaming_crc32)
-        item._predicted_index_item.contents_crc32 = zlib.crc32(buf,            item._predicted_index_item.contents_crc32)
+        item.streaming_crc32 = zlib.crc32(chunk_size_buf, item.streaming_crc32)
+        item.streaming_crc32, item._predicted_index_item.contents_crc32 = crc32_both(buf, item.streaming_crc32, item._predicted_index_item.contents_crc32)
 
         if item.done:
             self._current_item = None
@@ -231,16 +771,13 @@ class StreamingReader(BaseReader):
             if self.validating_index:
                 index_item = item._predicted_index_item
                 name = index_item.file_name_str.encode("utf8")
-                type_and_name_size = (index_item.file_type << 14) | len(name)
-                self._index_tmpfile.write((
-                    struct.pack("<QQLH",
-                        index_item.jump_location,
-                        index_item.file_size,
-                        index_item.contents_crc32,
-                        type_and_name_size,
-                    ) +
-                    name
-                ))
+                self._predicted_index.append(
+                    index_item.jump_location,
+                    index_item.file_size,
+                    index_item.contents_crc32,
+                    (index_item.file_type << 14) | len(name),
+                    name,
+                )
         return buf
 
     def skip_item(self, item):
@@ -252,28 +789,34 @@ class StreamingReader(BaseReader):
             # We're choosing not to validate any more of the archive.
             return
 
-        index_size_remaining = self._index_tmpfile.tell()
-        self._index_tmpfile.seek(0)
-
         # Start a new decompression stream.
         unused_data = self._decompressor.unused_data
         unused_data_len = len(unused_data)
         self._decompressor = Decompressor()
         index_location = self._input.tell() - unused_data_len
 
+        # Compare a batch of items at a time.
         index_crc32 = 0
-        while index_size_remaining > 0:
-            size = min(index_size_remaining, default_chunk_size)
-            calculated_buf = self._index_tmpfile.read(size)
-            found_buf = self._read(size, unused_data_from_previous_stream=unused_data)
-            unused_data = None
-            index_size_remaining -= size
-
-            assert len(calculated_buf) == size, "tmpfile modified mid-operation?"
-            assert len(found_buf) == size, "allow_eof=False makes this impossible to fail"
-            if calculated_buf != found_buf:
-                raise MalformedInputError("validating index failed")
-            index_crc32 = zlib.crc32(calculated_buf, index_crc32)
+        for jump_locations, file_sizes, contents_crc32s, type_and_name_sizes, name_ends, names in self._predicted_index.segments():
+            start = 0
+            while start < len(jump_locations):
+                end = min(len(jump_locations), start + predicted_index_batch_size)
+                names_start = name_ends[start - 1] if start > 0 else 0
+                size = (end - start) * _index_item_struct.size + name_ends[end - 1] - names_start
+                found_buf = self._read(size, unused_data_from_previous_stream=unused_data)
+                unused_data = None
+                assert len(found_buf) == size, "allow_eof=False makes this impossible to fail"
+
+                # Serialize the predicted batch without a Python-level loop, and compare it all at once.
+                name_starts = name_ends[start - 1:end - 1] if start > 0 else array("Q", [0]) + name_ends[:end - 1]
+                predicted_buf = b"".join(itertools.chain.from_iterable(zip(
+                    map(_index_item_struct.pack, jump_locations[start:end], file_sizes[start:end], contents_crc32s[start:end], type_and_name_sizes[start:end]),
+                    map(names.__getitem__, map(slice, name_starts, name_ends[start:end])),
+                )))
+                if predicted_buf != found_buf:
+                    raise MalformedInputError("validating index failed")
+                index_crc32 = zlib.crc32(found_buf, index_crc32)
+                start = end
 
         # Make sure we're at the end of the compression stream.
         extra = self._read(1, unused_data_from_previous_stream=unused_data, allow_eof=True)
@@ -302,39 +845,271 @@ class StreamingReader(BaseReader):
         # Everything's good.
 
     def _read(self, n, *, allow_eof=False, unused_data_from_previous_stream=None):
-        return _read_from_decompressor(self._decompressor, self._input, n, allow_eof=allow_eof, unused_data_from_previous_stream=unused_data_from_previous_stream)
+        if unused_data_from_previous_stream:
+            self._pending_input = unused_data_from_previous_stream
+        if len(self._output) - self._output_position < n:
+            self._fill(n)
+
+        start = self._output_position
+        available = len(self._output) - start
+        if available < n:
+            if allow_eof and available == 0 and self._decompressor.eof: return b""
+            raise MalformedInputError("unexpected end of stream")
+        self._output_position = start + n
+        return self._output[start:start + n]
+
+    def _fill(self, n):
+        """ Decompresses until at least n bytes are buffered or the compression stream ends. """
+        parts = [self._output[self._output_position:]]
+        size = len(parts[0])
+        decompressor = self._decompressor
+        # Note that you have to check EOF first, as the zlib.Decompress object leaves junk in the other fields once EOF has been hit.
+        while size < n and not decompressor.eof:
+            if self._pending_input:
+                chunk = self._pending_input
+                self._pending_input = None
+            elif decompressor.unconsumed_tail:
+                chunk = decompressor.unconsumed_tail
+            else:
+                chunk = self._input.read(large_chunk_size)
+                if len(chunk) == 0:
+                    # The decompressor can still be holding onto output after consuming all the input.
+                    buf = decompressor.decompress(b"", max(stream_output_block_size, n - size))
+                    if len(buf) == 0:
+                        # This is going to result in an error.
+                        break
+                    parts.append(buf)
+                    size += len(buf)
+                    continue
+            buf = decompressor.decompress(chunk, max(stream_output_block_size, n - size))
+            parts.append(buf)
+            size += len(buf)
+        self._output = b"".join(parts)
+        self._output_position = 0
 
 class IndexReader(BaseReader):
-    def __init__(self, file):
+    def __init__(self, file, checkpoint_cache=None, buffer=None, index_cache_path=None):
+        # Slice a memoryview of the whole archive when we have one. file may be None in that case.
         self._input = file
+        self._buffer = memoryview(buffer) if buffer != None else None
+        # Give a shared CheckpointCache to reuse decompression work across readers of the same archive.
+        self.checkpoint_cache = checkpoint_cache if checkpoint_cache != None else CheckpointCache()
 
         data_region_start = 4
-        self._stream_start = data_region_start
-        self._skip_bytes_since_stream_start = 0
 
         # ArchiveFooter
-        self._file_size = self._input.seek(0, os.SEEK_END)
+        self._file_size = len(self._buffer) if self._buffer != None else self._input.seek(0, os.SEEK_END)
         archive_footer_size = 16
         self.archive_footer_start = self._file_size - archive_footer_size
         if not (4 <= self.archive_footer_start): raise MalformedInputError("unexpected EOF")
-        self._input.seek(self.archive_footer_start)
         # archive_footer
-        archive_footer = self._input.read(archive_footer_size)
+        archive_footer = bytes(self._slice(self.archive_footer_start, self._file_size).read(archive_footer_size))
 
         self.index_location = _validate_archive_footer(archive_footer)
 
         if not (data_region_start <= self.index_location < self.archive_footer_start): raise MalformedInputError("index_location out of bounds")
 
         (self.index_crc32,) = struct.unpack("<L", archive_footer[0:4])
-        self._calculated_index_crc32 = 0
 
         # Start the Index Region.
-        self._index_file = FileSlice(self._input, self.index_location, self.archive_footer_start)
-        self._index_decompressor = Decompressor()
+        self._index_parser = self._parse_index()
+        self._index_cache = None
+        self._next_cached_item = 0
+        # Built on demand by get().
+        self._name_index = None
+        if index_cache_path != None:
+            self._open_index_cache(index_cache_path, archive_footer)
+
+        # Left positioned after the most recently finished item.
+        self._cursor = None
 
     def close(self):
-        self._input.close()
-        self._index_decompressor = None
+        self._index_parser = None
+        self._cursor = None
+        try:
+            if self._index_cache != None:
+                self._index_cache.close()
+        finally:
+            _close_input(self._input, self._buffer)
+
+    def _slice(self, start, end):
+        if self._buffer != None:
+            return BufferSlice(self._buffer, start, end)
+        return FileSlice(self._input, start, end)
+
+    def _parse_index(self):
+        return _IndexRegionParser(self._slice(self.index_location, self.archive_footer_start), self.index_crc32)
+
+    def _open_index_cache(self, index_cache_path, archive_footer):
+        """
+        Uses the sidecar index cache at the given path, first (re)building it if it's missing or stale.
+        Does nothing if the archive can't be identified or the cache can't be written.
+        """
+        key = cache_key(self._input, archive_footer)
+        if key == None: return
+        self._index_cache = load_index_cache(index_cache_path, key)
+        if self._index_cache != None: return
+
+        records = []
+        for item in self._parse_index():
+            records.append((
+                item.jump_location,
+                item.file_size,
+                item.file_type,
+                item.file_name_str.encode("utf8"),
+                item.contents_crc32,
+                item._stream_start,
+                item._skip_bytes_until_contents,
+            ))
+        try:
+            write_index_cache(index_cache_path, key, records)
+        except OSError:
+            # It's just a cache.
+            pass
+        else:
+            self._index_cache = load_index_cache(index_cache_path, key)
+
+    def next(self):
+        if self._index_cache == None:
+            return self._index_parser.next()
+
+        if self._next_cached_item >= len(self._index_cache): raise StopIteration
+        item = self._item_from_cache(self._next_cached_item)
+        self._next_cached_item += 1
+        return item
+
+    def get(self, name, default=None):
+        """
+        Returns the IndexItem with the given name (a str), or default if there isn't one.
+        If multiple items have the same name, this returns the first one.
+        Doesn't disturb iterating through the reader.
+        """
+        if self._index_cache != None:
+            i = self._index_cache.find(name.encode("utf8"))
+            if i == None: return default
+            return self._item_from_cache(i)
+
+        if self._name_index == None:
+            # Read the whole Index Region once.
+            self._name_index = {}
+            for item in self._parse_index():
+                # Trust the first item with any given name.
+                self._name_index.setdefault(item.file_name_str, item)
+        return self._name_index.get(name, default)
+
+    def stat(self, name):
+        """ Like get(), but raises ItemNotFoundError if there is no such item. """
+        item = self.get(name)
+        if item == None: raise ItemNotFoundError(name)
+        return item
+
+    def open(self, name):
+        """
+        Returns a seekable binary file object (an io.BufferedReader) for the contents of the item with the given name.
+        name can also be an IndexItem from this reader.
+        """
+        item = name if isinstance(name, IndexItem) else self.stat(name)
+        return io.BufferedReader(ItemFile(self, item))
+
+    def _item_from_cache(self, i):
+        jump_location, file_size, file_type, name, contents_crc32, stream_start, skip_bytes_until_contents = self._index_cache.record(i)
+        item = IndexItem(jump_location, file_size, file_type, _validate_archive_path(bytes(name)), contents_crc32)
+        item._stream_start = stream_start
+        item._skip_bytes_until_contents = skip_bytes_until_contents
+        return item
+
+    def open_item(self, item):
+        assert item._cursor == None, "already open"
+        item._cursor = self._cursor_at(item._stream_start, item._skip_bytes_until_contents)
+        item.done = False
+        item._remaining_bytes = item.file_size
+        item._chunk_remaining = 0
+        if item.file_type in (FILE_TYPE_DIRECTORY, FILE_TYPE_SYMLINK):
+            # Read the contents immediately. It's always bounded size.
+            _check_special_contents(item, self.read_from_item(item))
+
+    def _cursor_at(self, stream_start, offset):
+        cursor = self._cursor
+        if cursor != None and cursor.stream_start == stream_start and cursor.offset <= offset:
+            # Resume after the previously finished item instead of inflating the stream from the start again.
+            self._cursor = None
+        else:
+            cursor = None
+
+        if cursor == None or offset - cursor.offset >= self.checkpoint_cache.interval:
+            # Resume from the nearest checkpoint if it's closer.
+            checkpoint = self.checkpoint_cache.find(stream_start, offset)
+            if checkpoint != None and (cursor == None or cursor.offset < checkpoint[0]):
+                checkpoint_offset, decompressor, input_position = checkpoint
+                contents_file = self._slice(input_position, self.index_location)
+                cursor = _StreamCursor(stream_start, contents_file, decompressor, checkpoint_offset)
+
+        if cursor == None:
+            cursor = _StreamCursor(stream_start, self._slice(stream_start, self.index_location))
+        cursor.skip_to(offset, self.checkpoint_cache)
+        return cursor
+
+    def read_from_item(self, item):
+        """ Returns the rest of the current chunk of contents. """
+        assert item._cursor != None, "call open_item() first"
+        if item._chunk_remaining == 0:
+            self._read_chunk_size(item)
+        size = item._chunk_remaining
+        # Inflate straight into a buffer of the right size rather than concatenating.
+        buf = bytearray(size)
+        item._cursor.readinto(buf)
+        self._advance_item(item, size)
+        return buf
+
+    def read_from_item_into(self, item, buffer):
+        """
+        Inflates up to len(buffer) bytes of contents directly into the given writable buffer, spanning chunks as necessary.
+        Returns the number of bytes written, which is less than len(buffer) only when the item is done.
+        """
+        assert item._cursor != None, "call open_item() first"
+        view = memoryview(buffer)
+        filled = 0
+        while filled < len(view) and not item.done:
+            if item._chunk_remaining == 0:
+                self._read_chunk_size(item)
+            size = min(len(view) - filled, item._chunk_remaining)
+            item._cursor.readinto(view[filled:filled + size])
+            filled += size
+            self._advance_item(item, size)
+        return filled
+
+    def _read_chunk_size(self, item):
+        size = min(item._remaining_bytes, 0xffff)
+        # validate chunk_size.
+        if struct.unpack("<H", item._cursor.read(2))[0] != size: raise MalformedInputError("unexpected chunk_size")
+        item._chunk_remaining = size
+
+    def _advance_item(self, item, size):
+        item._chunk_remaining -= size
+        item._remaining_bytes -= size
+        if item._remaining_bytes == 0:
+            item.done = True
+            # Keep the decompressor around in case the next item is in the same stream.
+            self._cursor = item._cursor
+            # Reset in case you want to read it again.
+            item._cursor = None
+
+class _IndexRegionParser:
+    """
+    Parses IndexItems out of the Index Region, computing the offsets for random access along the way.
+    """
+    def __init__(self, index_file, index_crc32):
+        self._index_file = index_file
+        self._index_decompressor = Decompressor()
+        self.index_crc32 = index_crc32
+        self._calculated_index_crc32 = 0
+
+        data_region_start = 4
+        self._stream_start = data_region_start
+        self._skip_bytes_since_stream_start = 0
+
+    def __iter__(self): return self
+    def __next__(self): return self.next()
 
     def next(self):
         # IndexItem
@@ -382,42 +1157,10 @@ class IndexReader(BaseReader):
 
         return item
 
-    def open_item(self, item):
-        assert item._contents_file == None, "already open"
-        contents_file = FileSlice(self._input, item._stream_start, self.index_location)
-        decompressor = Decompressor()
-        skip_bytes = item._skip_bytes_until_contents
-        while skip_bytes > 0:
-            size = min(skip_bytes, default_chunk_size)
-            skipped_buf = _read_from_decompressor(decompressor, contents_file, size)
-            skip_bytes -= len(skipped_buf)
-        assert skip_bytes == 0
-        item.done = False
-        item._contents_file = contents_file
-        item._decompressor = decompressor
-        item._remaining_bytes = item.file_size
-
     def _read_index(self, n, *, allow_eof=False):
         # Pump more from the decompressor.
         return _read_from_decompressor(self._index_decompressor, self._index_file, n, allow_eof=allow_eof)
 
-    def read_from_item(self, item):
-        assert item._contents_file != None, "call open_item() first"
-        size = min(item._remaining_bytes, 0xffff)
-        buf = _read_from_decompressor(item._decompressor, item._contents_file, 2 + size)
-        # validate chunk_size.
-        if struct.unpack("<H", buf[:2])[0] != size: raise MalformedInputError("unexpected chunk_size")
-        buf = buf[2:]
-
-        item._remaining_bytes -= size
-        if item._remaining_bytes == 0:
-            item.done = True
-            # Reset in case you want to read it again.
-            item._contents_file = None
-            item._decompressor = None
-
-        return buf
-
 class DataItem:
     def __init__(self, file_type, file_name_str, streaming_crc32_so_far):
         self.file_type = file_type
@@ -435,10 +1178,138 @@ class IndexItem:
         self.contents_crc32 = contents_crc32
         # Used after opening the item:
         self.done = None
-        self._contents_file = None
-        self._decompressor = None
+        self._cursor = None
         self._remaining_bytes = None
+        self._chunk_remaining = None
+
+class ItemFile(io.RawIOBase):
+    """
+    A seekable read-only raw file object for the contents of an IndexItem. See IndexReader.open().
+    Leaves checkpoints in the reader's CheckpointCache while reading,
+    so that seeking backward resumes from a nearby checkpoint rather than from the start of the stream.
+    """
+    def __init__(self, reader, item):
+        self._reader = reader
+        self._item = item
+        self._position = 0
+        # Positioned at self._position, or None if we need to seek.
+        self._cursor = None
+
+    def readable(self): return True
+    def seekable(self): return True
+    def tell(self): return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:   position = offset
+        elif whence == io.SEEK_CUR: position = self._position + offset
+        elif whence == io.SEEK_END: position = self._item.file_size + offset
+        else: raise ValueError("invalid whence: " + repr(whence))
+        if position < 0: raise ValueError("negative seek position: " + repr(position))
+        if position != self._position:
+            self._position = position
+            self._release_cursor()
+        return position
+
+    def readinto(self, b):
+        remaining = self._item.file_size - self._position
+        if remaining <= 0 or len(b) == 0: return 0
+
+        offset_in_chunk = self._position % 0xFFFF
+        if self._cursor == None:
+            # Each chunk of 0xFFFF bytes is preceded by a 2-byte chunk_size.
+            chunk_start = self._item._skip_bytes_until_contents + (self._position // 0xFFFF) * (2 + 0xFFFF)
+            offset = chunk_start + (2 + offset_in_chunk if offset_in_chunk > 0 else 0)
+            self._cursor = self._reader._cursor_at(self._item._stream_start, offset)
+        if offset_in_chunk == 0:
+            # validate chunk_size.
+            if struct.unpack("<H", self._cursor.read(2))[0] != min(remaining, 0xFFFF): raise MalformedInputError("unexpected chunk_size")
+
+        size = min(len(b), remaining, 0xFFFF - offset_in_chunk)
+        checkpoint_cache = self._reader.checkpoint_cache
+        # Stop at every multiple of the interval to leave a checkpoint.
+        interval = checkpoint_cache.interval
+        size = min(size, interval - self._cursor.offset % interval)
+        self._cursor.readinto(memoryview(b)[:size])
+        if self._cursor.offset % interval == 0:
+            self._cursor.checkpoint(checkpoint_cache)
+
+        self._position += size
+        return size
+
+    def close(self):
+        self._release_cursor()
+        super().close()
+
+    def _release_cursor(self):
+        if self._cursor != None:
+            # Let the reader resume from here for whatever comes next.
+            self._reader._cursor = self._cursor
+            self._cursor = None
+
+class _StreamCursor:
+    """
+    A decompressor somewhere in the middle of a compression stream in the Data Region.
+    offset is the number of decompressed bytes since the start of the stream.
+    """
+    def __init__(self, stream_start, contents_file, decompressor=None, offset=0):
+        self.stream_start = stream_start
+        self.offset = offset
+        self._contents_file = contents_file
+        self._decompressor = decompressor if decompressor != None else Decompressor()
+
+    def read(self, n):
+        buf = _read_from_decompressor(self._decompressor, self._contents_file, n)
+        self.offset += len(buf)
+        return buf
 
+    def readinto(self, buffer):
+        n = _read_from_decompressor_into(self._decompressor, self._contents_file, buffer)
+        self.offset += n
+        return n
+
+    def skip_to(self, offset, checkpoint_cache=None):
+        """ Inflates and discards up to offset, leaving checkpoints along the way if given a CheckpointCache. """
+        assert self.offset <= offset
+        last_checkpoint_offset = self.offset
+        while self.offset < offset:
+            size = min(offset - self.offset, default_chunk_size)
+            if checkpoint_cache != None:
+                # Stop at every multiple of the interval.
+                interval = checkpoint_cache.interval
+                size = min(size, interval - self.offset % interval)
+            self.read(size)
+            if checkpoint_cache != None and self.offset % interval == 0:
+                self.checkpoint(checkpoint_cache)
+                last_checkpoint_offset = self.offset
+        if checkpoint_cache != None and offset - last_checkpoint_offset >= checkpoint_cache.interval // 4:
+            # Worth remembering the destination too.
+            self.checkpoint(checkpoint_cache)
+
+    def checkpoint(self, checkpoint_cache):
+        checkpoint_cache.put(self.stream_start, self.offset, self._decompressor, self._contents_file.start)
+
+
+def _close_input(file, buffer):
+    try:
+        if buffer != None:
+            release_buffer(buffer)
+    finally:
+        if file != None:
+            file.close()
+
+def _check_special_contents(item, buf):
+    if item.file_type == FILE_TYPE_DIRECTORY:
+        if len(buf) > 0: raise MalformedInputError("directory items must have 0-length contents")
+    elif item.file_type == FILE_TYPE_SYMLINK:
+        if len(buf) > 4095: raise MalformedInputError("symlink length exceeds 4095")
+        try:
+            item.symlink_target = buf.decode("utf8")
+        except UnicodeDecodeError as e:
+            raise MalformedInputError("symlink target invalid utf8: " + str(e))
+        try:
+            validate_archive_path(item.symlink_target, file_name_of_symlink=item.file_name_str)
+        except InvalidArchivePathError as e:
+            raise MalformedInputError("illegal symlink target: " + str(e))
 
 def _validate_archive_path(name):
     try:
@@ -482,8 +1353,13 @@ def _read_from_decompressor(decompressor, file, decompressed_len, *, allow_eof=F
         # Read more data from the file and feed it to the decompressor.
         chunk = file.read(default_chunk_size)
         if len(chunk) == 0:
-            # This is going to result in an error.
-            break
+            # The decompressor can still be holding onto output after consuming all the input.
+            buf = decompressor.decompress(b"", remaining)
+            if len(buf) == 0:
+                # This is going to result in an error.
+                break
+            result += buf
+            continue
         #print("input: " + repr(chunk), file=sys.stderr)
         result += decompressor.decompress(chunk, remaining)
 
@@ -492,6 +1368,37 @@ def _read_from_decompressor(decompressor, file, decompressed_len, *, allow_eof=F
     if allow_eof and decompressor.eof and len(result) == 0: return b''
     raise MalformedInputError("unexpected end of stream")
 
+def _read_from_decompressor_into(decompressor, file, buffer):
+    """
+    Like _read_from_decompressor(), but inflates exactly len(buffer) bytes into the given writable buffer
+    without building any intermediate result.
+    Returns len(buffer).
+    """
+    view = memoryview(buffer)
+    filled = 0
+    while filled < len(view):
+        # Note that you have to check EOF first, as the zlib.Decompress object leaves junk in the other fields once EOF has been hit.
+        if decompressor.eof: break
+
+        remaining = len(view) - filled
+        if decompressor.unconsumed_tail:
+            buf = decompressor.decompress(decompressor.unconsumed_tail, remaining)
+        else:
+            chunk = file.read(large_chunk_size)
+            if len(chunk) == 0:
+                # The decompressor can still be holding onto output after consuming all the input.
+                buf = decompressor.decompress(b"", remaining)
+                if len(buf) == 0:
+                    # This is going to result in an error.
+                    break
+            else:
+                buf = decompressor.decompress(chunk, remaining)
+        view[filled:filled + len(buf)] = buf
+        filled += len(buf)
+
+    if filled < len(view): raise MalformedInputError("unexpected end of stream")
+    return filled
+
 def Decompressor():
     return zlib.decompressobj(wbits=-zlib.MAX_WBITS)
 
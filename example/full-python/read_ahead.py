@@ -0,0 +1,90 @@
+import threading
+import queue
+
+class ReadAheadFile:
+    """
+    A read-only, non-seekable file-like object that reads the given binary file ahead on a background thread
+    into a bounded queue of large blocks, such that slow reads, e.g. from a network filesystem or pipe,
+    overlap with whatever the caller is doing with the data.
+    Like a buffered file, read(n) only returns fewer than n bytes at EOF.
+    The background thread owns the given file and closes it when it's done,
+    which is after close() only once any read already in progress returns.
+    """
+    def __init__(self, file, block_size=0x100000, max_blocks=8):
+        self._file = file
+        self._block_size = block_size
+        self._blocks = queue.Queue(maxsize=max_blocks)
+        self._block = b""
+        self._block_position = 0
+        self._position = 0
+        self._eof = False
+        self._closed = threading.Event()
+        # A daemon, because there's no interrupting a blocking read from a pipe.
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self): return self
+    def __exit__(self, *args): self.close()
+
+    def readable(self): return True
+    def seekable(self): return False
+    def tell(self): return self._position
+
+    def read(self, n=-1):
+        parts = []
+        size = 0
+        while n < 0 or size < n:
+            if self._block_position == len(self._block):
+                if not self._next_block(): break
+            end = len(self._block) if n < 0 else min(len(self._block), self._block_position + n - size)
+            parts.append(self._block[self._block_position:end])
+            size += end - self._block_position
+            self._block_position = end
+        self._position += size
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+    def close(self):
+        if self._closed.is_set(): return
+        self._closed.set()
+        # Make room in case the thread is waiting to put a block.
+        try:
+            while True: self._blocks.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _next_block(self):
+        if self._eof: return False
+        block = self._blocks.get()
+        if isinstance(block, BaseException):
+            self._eof = True
+            raise block
+        if len(block) == 0:
+            self._eof = True
+            return False
+        self._block = block
+        self._block_position = 0
+        return True
+
+    def _run(self):
+        # Don't wait for a whole block from a buffered pipe when some is already available.
+        read = getattr(self._file, "read1", self._file.read)
+        try:
+            while not self._closed.is_set():
+                block = read(self._block_size)
+                self._put(block)
+                if len(block) == 0: return
+        except BaseException as e:
+            if not self._closed.is_set():
+                self._put(e)
+        finally:
+            # Not in close(), which would close the file out from under a blocking read,
+            # and the fd number could even be reused for another file by then.
+            self._file.close()
+
+    def _put(self, block):
+        while not self._closed.is_set():
+            try:
+                self._blocks.put(block, timeout=0.1)
+                return
+            except queue.Full:
+                pass
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+import sys
+import zlib
+import fnmatch
+
+from common import *
+from create import Writer, ItemWriter, data_item_header
+from read import open_path
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=
+        "Filters and concatenates existing archives into a new archive. "
+        "Compression streams whose items are all kept are copied verbatim without decompressing them; "
+        "only the streams at the edges of removed items are recompressed.")
+    parser.add_argument("archives", nargs="+", help=
+        "Input archives, which must have an index. Items are kept in order, with each archive's items after the previous archive's.")
+    parser.add_argument("-o", "--output", required=True, help=
+        "Path to write the new archive to, or '-' for stdout.")
+    parser.add_argument("--include", metavar="PATTERN", action="append", default=[], help=
+        "Only keep items whose names match any of these fnmatch patterns. Default is all items.")
+    parser.add_argument("--exclude", metavar="PATTERN", action="append", default=[], help=
+        "Drop items whose names match any of these fnmatch patterns.")
+    parser.add_argument("--drop-shadowed", action="store_true", help=
+        "Drop items with the same name as an earlier kept item, which readers ignore anyway.")
+    parser.add_argument("--stream-split-threshold", type=int, default=0x10000, help=
+        "See create.py. Only applies to recompressed items.")
+    parser.add_argument("-l", "--level", type=int, default=zlib.Z_DEFAULT_COMPRESSION, choices=range(-1, 10), help=
+        "See create.py. Only applies to recompressed items.")
+    parser.add_argument("-v", "--verbose", action="store_true", help=
+        "Report how much was copied verbatim.")
+    args = parser.parse_args()
+
+    readers = []
+    try:
+        entries = []
+        seen_names = set()
+        for archive_path in args.archives:
+            reader = open_path(archive_path, require_index=True)
+            readers.append(reader)
+            for item in reader:
+                name = item.file_name_str
+                if args.include and not any(fnmatch.fnmatchcase(name, pattern) for pattern in args.include): continue
+                if any(fnmatch.fnmatchcase(name, pattern) for pattern in args.exclude): continue
+                if args.drop_shadowed:
+                    if name in seen_names: continue
+                    seen_names.add(name)
+                entries.append((reader, item))
+
+        stats = rewrite(
+            entries,
+            output_path=sys.stdout.buffer if args.output == "-" else args.output,
+            stream_split_threshold=args.stream_split_threshold,
+            level=args.level,
+        )
+    finally:
+        for reader in readers:
+            reader.close()
+
+    if args.verbose:
+        print("items copied verbatim: {}/{}".format(stats.copied_items, len(entries)), file=sys.stderr)
+        print("compressed bytes copied verbatim: {}".format(stats.copied_bytes), file=sys.stderr)
+
+class RewriteStats:
+    def __init__(self):
+        self.copied_items = 0
+        self.copied_bytes = 0
+        self.recompressed_items = 0
+
+def rewrite(entries, output_path, stream_split_threshold=0x10000, level=zlib.Z_DEFAULT_COMPRESSION):
+    """
+    Writes a new archive containing the given items.
+    entries is a list of (reader, item) where reader is an IndexReader and item is an item from iterating over it.
+    Whole compression streams of a source archive are copied verbatim when the output keeps all of the stream's items in order,
+    and other items are decompressed and recompressed.
+    Copied streams are trusted, not validated.
+    Returns a RewriteStats.
+    """
+    sources = {}
+    for reader, _ in entries:
+        if id(reader) not in sources:
+            sources[id(reader)] = _Source(reader)
+    # Entries as (source, item number).
+    entries = [(sources[id(reader)], sources[id(reader)].item_number(item)) for reader, item in entries]
+
+    stats = RewriteStats()
+    with _RewriteWriter(output_path, stream_split_threshold, level) as writer:
+        # Whether a copied stream ended with the DataItem header of the current entry.
+        header_written = False
+        i = 0
+        while i < len(entries):
+            source, k = entries[i]
+            count = _copyable_stream_run(entries, i)
+            if count > 0:
+                end_of_stream = source.stream_end(k)
+                writer.copy_stream(source, k, count, end_of_stream, header_written)
+                stats.copied_items += count
+                stats.copied_bytes += end_of_stream - source.items[k]._stream_start
+                i += count
+                header_written = True
+                continue
+
+            item = source.items[k]
+            if header_written:
+                item_writer = _ContinuedItemWriter(writer, item.file_name_str, item.file_type, item.file_size)
+            else:
+                item_writer = writer.open_item(item.file_name_str, item.file_type, item.file_size)
+            source.reader.open_item(item)
+            if item.file_type == FILE_TYPE_SYMLINK:
+                item_writer.write(item.symlink_target.encode("utf8"))
+            while not item.done:
+                item_writer.write(source.reader.read_from_item(item))
+            item_writer.close()
+            stats.recompressed_items += 1
+            i += 1
+            header_written = False
+    return stats
+
+def _copyable_stream_run(entries, i):
+    """
+    Returns the number of entries starting at i that are exactly a whole compression stream of their source archive, or 0.
+    A stream other than the last ends with the DataItem header of the first item of the next stream,
+    so that item has to come next. The last stream can only be copied to the end of the output.
+    Stream 0 starts with a DataItem header, so it can only be copied to the start of the output,
+    unless it's only that header, and item 0's contents start the next stream.
+    """
+    source, k = entries[i]
+    items = source.items
+    if not (k == 0 or items[k].jump_location != 0):
+        # Not the start of a stream.
+        return 0
+    if k == 0 and items[0].jump_location == 0 and i != 0: return 0
+    end = k + 1
+    while end < len(items) and items[end].jump_location == 0:
+        end += 1
+    count = end - k
+    for j in range(count):
+        if i + j >= len(entries) or entries[i + j] != (source, k + j): return 0
+    if end < len(items):
+        if i + count >= len(entries) or entries[i + count] != (source, end): return 0
+    else:
+        if i + count != len(entries): return 0
+    return count
+
+class _Source:
+    def __init__(self, reader):
+        self.reader = reader
+        self.items = None
+        self._item_numbers = None
+
+    def item_number(self, item):
+        if self.items == None:
+            # Include items that were not selected to know where the streams are.
+            self.items = list(self.reader._parse_index())
+            self._item_numbers = {(item._stream_start, item._skip_bytes_until_contents): i for i, item in enumerate(self.items)}
+        return self._item_numbers[(item._stream_start, item._skip_bytes_until_contents)]
+
+    def stream_end(self, k):
+        """ Returns the location of the end of the compression stream starting with item k's contents. """
+        for item in self.items[k + 1:]:
+            if item.jump_location != 0: return item.jump_location
+        return self.reader.index_location
+
+class _RewriteWriter(Writer):
+    def __init__(self, output_path, stream_split_threshold, level):
+        super().__init__(root=None, output_path=output_path, stream_split_threshold=stream_split_threshold, level=level)
+
+    def copy_stream(self, source, k, count, end_of_stream, header_written):
+        """
+        Copies the compression stream starting with the contents of source item k verbatim.
+        If header_written, the previous copied stream ended with item k's DataItem header.
+        """
+        items = source.items
+        stream_start = items[k]._stream_start
+        if header_written:
+            jump_location = self._output.tell()
+        elif k == 0 and items[0].jump_location == 0:
+            # Stream 0 includes the first DataItem header. Nothing has been written to our stream 0 yet, so drop it.
+            assert self._output.tell() == 4 and self._stream_uncompressed_size == 0
+            jump_location = 0
+        else:
+            # End our stream after the DataItem header, such that the copied stream is where the contents start.
+            self._write(data_item_header(items[k].file_name_str.encode("utf8"), items[k].file_type))
+            self._output.write(self._compressor.flush())
+            jump_location = self._output.tell()
+        self._compressor = None
+
+        contents = source.reader._slice(stream_start, end_of_stream)
+        while True:
+            buf = contents.read(0x100000)
+            if len(buf) == 0: break
+            self._output.write(buf)
+
+        for j in range(k, k + count):
+            item = items[j]
+            name = item.file_name_str.encode("utf8")
+            self._add_index_item(
+                jump_location if j == k else 0,
+                item.file_size,
+                item.contents_crc32,
+                (item.file_type << 14) | len(name),
+                name,
+            )
+
+class _ContinuedItemWriter(ItemWriter):
+    """ For an item whose DataItem header was at the end of a copied stream. Its contents start a new stream. """
+    def _start(self, buf):
+        writer = self._writer
+        self._streaming_crc32 = zlib.crc32(self._header())
+        writer._start_stream(writer.level)
+        self._jump_location = writer._output.tell()
+
+if __name__ == "__main__":
+    main()
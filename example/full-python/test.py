@@ -7,10 +7,15 @@ import itertools
 import io
 import json
 import zlib
+import random
+import threading
 
-from read import reader_for_file
+from read import reader_for_file, open_path
+from create import Writer, prefetch
+from checkpoint_cache import CheckpointCache
 from common import (
     PoafException,
+    MalformedInputError,
     FILE_TYPE_NORMAL_FILE,
     FILE_TYPE_POSIX_EXECUTABLE,
     FILE_TYPE_DIRECTORY,
@@ -29,6 +34,21 @@ def main():
 
     test_from_data(args.verbose)
     test_create()
+    test_random_access()
+    test_duplicate_names()
+    test_parallel_create()
+    test_recursive_create()
+    test_adaptive_level()
+    test_split_policy()
+    test_in_memory_sources()
+    test_async()
+    test_rewrite()
+    test_streaming_block_size()
+    test_read_ahead()
+    test_predicted_index()
+    test_verify()
+    test_parallel_crc()
+    test_directory_cache()
 
 def canonicalize_test_data(test_data):
     for test_case in test_data:
@@ -79,8 +99,11 @@ def test_from_data(verbose):
         print("{0}/{0} pass".format(current_group_count))
 
 def run_test(test):
-    contents = io.BytesIO(test["contents"])
+    # Both through a file-like object and directly from memory.
+    run_test_with_contents(test, io.BytesIO(test["contents"]))
+    run_test_with_contents(test, test["contents"])
 
+def run_test_with_contents(test, contents):
     expect_error = False
     expected_items = []
     if test.get("error", None) != None:
@@ -131,6 +154,7 @@ def test_create():
 
     for options in (tuple(itertools.chain(*v)) for v in itertools.product(
         [(), ("--stream-split-threshold=0",)],
+        [(), ("--jobs=3",)],
 
         #[("--some-specific-test",)],
     )):
@@ -164,6 +188,787 @@ def test_create():
                     subprocess.run(cmd, cwd=this_dir, check=True)
                 assert_dir(d, file_name_args, file_names)
 
+            # Extract random access in index order
+            with tempfile.TemporaryDirectory() as d:
+                cmd = ["./read.py", archive_path, "--extract", d]
+                cmd.extend(file_names)
+                subprocess.run(cmd, cwd=this_dir, check=True)
+                assert_dir(d, file_name_args, file_names)
+
+            # Extract streaming pipelined
+            with tempfile.TemporaryDirectory() as d:
+                cmd = ["./read.py", archive_path, "--extract", d, "--pipeline", "--jobs", "3"]
+                subprocess.run(cmd, cwd=this_dir, check=True)
+                assert_dir(d, file_name_args, file_names)
+
+            # Extract from a pipe, which is pipelined with --jobs.
+            for archive_arg, jobs in [("-", "1"), ("-", "3"), ("/dev/stdin", "3")]:
+                with tempfile.TemporaryDirectory() as d:
+                    cmd = ["./read.py", archive_arg, "--extract", d, "--jobs", jobs]
+                    subprocess.run(cmd, cwd=this_dir, input=read_file(archive_path), check=True)
+                    assert_dir(d, file_name_args, file_names)
+            cmd = ["./read.py", "-"]
+            lines = subprocess.run(cmd, cwd=this_dir, input=read_file(archive_path), stdout=subprocess.PIPE, check=True).stdout.decode("utf8").splitlines()
+            assert lines == file_names
+
+            # Extract random access in parallel
+            with tempfile.TemporaryDirectory() as d:
+                cmd = ["./read.py", archive_path, "--extract", d, "--jobs", "3"]
+                subprocess.run(cmd, cwd=this_dir, check=True)
+                assert_dir(d, file_name_args, file_names)
+
+def test_random_access():
+    print("testing: random access")
+    # Several large items in a single compression stream.
+    rng = random.Random(0)
+    contents = [rng.randbytes(rng.randrange(0x40000)) * 2 for _ in range(8)]
+    with tempfile.TemporaryDirectory() as d:
+        archive_path = os.path.join(d, "archive.poaf")
+        with Writer(root=d, output_path=archive_path, stream_split_threshold=0xFFFFFFFF) as writer:
+            for i, buf in enumerate(contents):
+                input_path = os.path.join(d, str(i))
+                with open(input_path, "wb") as f:
+                    f.write(buf)
+                writer.add(input_path)
+
+        checkpoint_cache = CheckpointCache(interval=0x10000)
+        for _ in range(2):
+            with open_path(archive_path, checkpoint_cache=checkpoint_cache) as reader:
+                items = list(reader)
+                for i in reversed(range(len(items))):
+                    expect_equal(contents[i], read_item(reader, items[i]))
+                    expect_equal(contents[i], read_item(reader, reader.stat(str(i))))
+        assert checkpoint_cache.hits > 0
+
+        # Inflating into a buffer that doesn't line up with chunks.
+        with open_path(archive_path) as reader:
+            buffer = bytearray(12345)
+            for item, expected_contents in zip(reader, contents):
+                reader.open_item(item)
+                buf = io.BytesIO()
+                while not item.done:
+                    buf.write(buffer[:reader.read_from_item_into(item, buffer)])
+                expect_equal(expected_contents, buf.getvalue())
+
+        # Seeking around within items.
+        with open_path(archive_path) as reader:
+            for i in reversed(range(len(contents))):
+                with reader.open(str(i)) as f:
+                    f.seek(max(0, len(contents[i]) - 100))
+                    expect_equal(contents[i][-100:], f.read())
+                    for position in sorted(rng.randrange(len(contents[i]) + 1) for _ in range(4))[::-1]:
+                        f.seek(position)
+                        expect_equal(contents[i][position:position + 0x12345], f.read(0x12345))
+                    f.seek(0)
+                    buf = bytearray(len(contents[i]) + 1)
+                    expect_equal(len(contents[i]), f.readinto(buf))
+                    expect_equal(contents[i], buf[:len(contents[i])])
+
+        # With a sidecar index cache: building it, using it, and rebuilding it when it's stale.
+        index_cache_path = archive_path + ".idx"
+        for mtime in (None, None, 1234567890):
+            if mtime != None:
+                os.utime(archive_path, (mtime, mtime))
+            with open_path(archive_path, index_cache_path=index_cache_path) as reader:
+                assert reader._index_cache != None
+                items = list(reader)
+                expect_equal(len(contents), len(items))
+                for i in reversed(range(len(items))):
+                    expect_equal(contents[i], read_item(reader, items[i]))
+                expect_equal(items[3].file_size, reader.stat(items[3].file_name_str).file_size)
+                expect_equal(None, reader.get("nope"))
+
+        # A damaged cache is rebuilt too: a flipped byte in the names, and a truncated file.
+        name = items[3].file_name_str.encode("utf8")
+        for damage in (lambda buf: buf.replace(name, bytes([name[0] ^ 1]) + name[1:]), lambda buf: buf[:-1]):
+            with open(index_cache_path, "r+b") as f:
+                buf = damage(f.read())
+                f.seek(0)
+                f.truncate()
+                f.write(buf)
+            for _ in range(2):
+                with open_path(archive_path, index_cache_path=index_cache_path) as reader:
+                    expect_equal([item.file_name_str for item in items], [item.file_name_str for item in reader])
+                    expect_equal(items[3].file_size, reader.stat(items[3].file_name_str).file_size)
+
+        # Also from memory.
+        with reader_for_file(bytearray(read_file(archive_path))) as reader:
+            items = list(reader)
+            for i in reversed(range(len(items))):
+                expect_equal(contents[i], read_item(reader, items[i]))
+
+def test_duplicate_names():
+    print("testing: duplicate names")
+    with tempfile.TemporaryDirectory() as d:
+        archive_path = os.path.join(d, "archive.poaf")
+        with Writer(root=d, output_path=archive_path, stream_split_threshold=0x10000) as writer:
+            for buf in (b"first", b"second"):
+                input_path = os.path.join(d, "input")
+                with open(input_path, "wb") as f:
+                    f.write(buf)
+                writer.add(input_path + "->f:x")
+
+        for index_cache_path in (None, archive_path + ".idx"):
+            with open_path(archive_path, index_cache_path=index_cache_path) as reader:
+                expect_equal(b"first", read_item(reader, reader.stat("x")))
+                expect_equal(["x", "x"], [item.file_name_str for item in reader])
+
+def test_parallel_create():
+    print("testing: parallel create")
+    # Splitting by uncompressed size, the output must not depend on the number of jobs.
+    archives = []
+    for jobs in (1, 2, 5):
+        cmd = ["./create.py", "--jobs", str(jobs), "--stream-split-threshold=5000", "--split-by-uncompressed-size", "--output", "-"]
+        cmd.extend(["create.py", "read.py", "common.py", "test.py", "/dev/null->f:empty.txt"])
+        archives.append(subprocess.run(cmd, stdout=subprocess.PIPE, cwd=this_dir, check=True).stdout)
+    expect_equal(archives[0], archives[1])
+    expect_equal(archives[0], archives[2])
+    # Sequential mode splits on compressed size by default.
+    cmd = ["./create.py", "--stream-split-threshold=5000", "--output", "-", "create.py", "read.py", "common.py", "test.py", "/dev/null->f:empty.txt"]
+    sequential = subprocess.run(cmd, stdout=subprocess.PIPE, cwd=this_dir, check=True).stdout
+    assert sequential != archives[0]
+    with reader_for_file(sequential) as reader:
+        expect_equal(["create.py", "read.py", "common.py", "test.py", "empty.txt"], [item.file_name_str for item in reader])
+    with reader_for_file(archives[0]) as reader:
+        expect_equal(["create.py", "read.py", "common.py", "test.py", "empty.txt"], [item.file_name_str for item in reader])
+        assert any(item.jump_location > 0 for item in reader_for_file(archives[0]))
+
+def test_recursive_create():
+    print("testing: recursive create")
+    with tempfile.TemporaryDirectory() as d:
+        src = os.path.join(d, "src")
+        os.makedirs(os.path.join(src, "a/b"))
+        os.makedirs(os.path.join(src, "empty"))
+        with open(os.path.join(src, "a/b/file.txt"), "wb") as f:
+            f.write(b"nested")
+        with open(os.path.join(src, "a/run.sh"), "wb") as f:
+            f.write(b"#!/bin/sh\n")
+        os.chmod(os.path.join(src, "a/run.sh"), 0o755)
+        os.symlink("b/file.txt", os.path.join(src, "a/link"))
+        expected = [
+            ("a/b/file.txt", FILE_TYPE_NORMAL_FILE),
+            ("a/link", FILE_TYPE_SYMLINK),
+            ("a/run.sh", FILE_TYPE_POSIX_EXECUTABLE),
+            ("empty", FILE_TYPE_DIRECTORY),
+        ]
+
+        archive_path = os.path.join(d, "archive.poaf")
+        for cmd, stdin, expected_order in [
+            (["-r", src], None, [0, 1, 2, 3]),
+            (["-r", "--files-from", "-", "--null"], b"\0".join(os.path.join(src, x).encode() for x in ("a", "empty")), [0, 1, 2, 3]),
+            # Grouped by extension.
+            (["-r", src, "--order", "similar"], None, [1, 3, 2, 0]),
+        ]:
+            subprocess.run(["./create.py", "--root", src, "--output", archive_path] + cmd, input=stdin, cwd=this_dir, check=True)
+            with open_path(archive_path) as reader:
+                expect_equal([expected[i] for i in expected_order], [(item.file_name_str, item.file_type) for item in reader])
+
+            with tempfile.TemporaryDirectory() as out:
+                subprocess.run(["./read.py", archive_path, "--extract", out], cwd=this_dir, check=True)
+                expect_equal(b"nested", read_file(os.path.join(out, "a/b/file.txt")))
+                expect_equal("b/file.txt", os.readlink(os.path.join(out, "a/link")))
+                assert os.access(os.path.join(out, "a/run.sh"), os.X_OK)
+                assert os.path.isdir(os.path.join(out, "empty"))
+
+    # Closing prefetch() stops its thread even though the iterable never ends.
+    stopped = threading.Event()
+    def endless():
+        try:
+            yield from itertools.count()
+        finally:
+            stopped.set()
+    entries = prefetch(endless(), max_pending=10)
+    expect_equal([0, 1, 2], list(itertools.islice(entries, 3)))
+    entries.close()
+    assert stopped.wait(10)
+
+def test_adaptive_level():
+    print("testing: adaptive level")
+    rng = random.Random(0)
+    contents = [
+        ("text.txt", b"".join(b"line %d\n" % i for i in range(20000))),
+        ("random.bin", bytes(rng.getrandbits(8) for _ in range(0x30000))),
+        ("small.txt", b"small"),
+        ("more_text.txt", b"".join(b"more %d\n" % i for i in range(20000))),
+    ]
+    for jobs in (1, 3):
+        with tempfile.TemporaryDirectory() as d:
+            archive_path = os.path.join(d, "archive.poaf")
+            with Writer(root=d, output_path=archive_path, stream_split_threshold=0x100000, jobs=jobs, adaptive_level=True) as writer:
+                for name, buf in contents:
+                    with open(os.path.join(d, name), "wb") as f:
+                        f.write(buf)
+                    writer.add(os.path.join(d, name))
+            with open_path(archive_path) as reader:
+                items = list(reader)
+                expect_equal([name for name, _ in contents], [item.file_name_str for item in items])
+                # The random item is stored in its own stream, which the small item joins rather than splitting again,
+                # and the next compressible item switches back.
+                expect_equal([0, 1, 0, 1], [int(item.jump_location > 0) for item in items])
+                for item, (_, buf) in zip(items, contents):
+                    expect_equal(buf, read_item(reader, item))
+
+            # Small compressible items after a stored one are compressed again once the stream splits for other reasons.
+            small_contents = [("small%d.txt" % i, b"".join(b"small %d line %d\n" % (i, j) for j in range(200))) for i in range(100)]
+            with Writer(root=None, output_path=archive_path, stream_split_threshold=0x1000, jobs=jobs, adaptive_level=True) as writer:
+                writer.add_bytes("random.bin", contents[1][1])
+                for name, buf in small_contents:
+                    writer.add_bytes(name, buf)
+            small_size = sum(len(buf) for _, buf in small_contents)
+            assert os.path.getsize(archive_path) < len(contents[1][1]) + small_size // 2
+            with open_path(archive_path) as reader:
+                items = list(reader)
+                assert sum(int(item.jump_location > 0) for item in items) > 2
+                for item, (_, buf) in zip(items[1:], small_contents):
+                    expect_equal(buf, read_item(reader, item))
+
+def test_split_policy():
+    print("testing: split policy")
+    rng = random.Random(0)
+    contents = [("small%d.txt" % i, b"x" * rng.randrange(1000)) for i in range(50)]
+    contents.insert(20, ("large.txt", b"y" * 5000))
+    for jobs in (1, 3):
+        with tempfile.TemporaryDirectory() as d:
+            archive_path = os.path.join(d, "archive.poaf")
+            with Writer(root=d, output_path=archive_path, stream_split_threshold=1 << 60, jobs=jobs, max_skip_bytes=3000, split_before_size=4000) as writer:
+                for name, buf in contents:
+                    with open(os.path.join(d, name), "wb") as f:
+                        f.write(buf)
+                    writer.add(os.path.join(d, name))
+            with open_path(archive_path) as reader:
+                items = list(reader)
+                for item, (name, buf) in zip(items, contents):
+                    assert item._skip_bytes_until_contents <= 3000, (name, item._skip_bytes_until_contents)
+                    expect_equal(buf, read_item(reader, item))
+                expect_equal(0, items[20]._skip_bytes_until_contents)
+                # Tiny items are still packed together.
+                assert len(set(item._stream_start for item in items)) < 20
+
+def test_in_memory_sources():
+    print("testing: in-memory sources")
+    rng = random.Random(0)
+    big = bytes(rng.getrandbits(8) for _ in range(0x30000)) + b"a" * 0x20000
+
+    class ShortReads(io.RawIOBase):
+        # Like a pipe or socket.
+        def __init__(self, buf): self._file = io.BytesIO(buf)
+        def readable(self): return True
+        def readinto(self, b): return self._file.readinto(memoryview(b)[:rng.randrange(1, 5000)])
+
+    def uneven_chunks(buf):
+        i = 0
+        while i < len(buf):
+            n = rng.choice([0, 1, 0xffff, 0x10000, rng.randrange(100000)])
+            yield buf[i:i + n]
+            i += n
+
+    for jobs in (1, 3):
+        with tempfile.TemporaryDirectory() as d:
+            archive_path = os.path.join(d, "archive.poaf")
+            with Writer(root=d, output_path=archive_path, stream_split_threshold=0x10000, jobs=jobs) as writer:
+                writer.add_bytes("bytes", big)
+                writer.add_bytes("memoryview", memoryview(big)[10:])
+                writer.add_bytes("exactly_one_chunk", b"b" * 0xffff)
+                writer.add_bytes("empty", b"")
+                writer.add_stream("stream", ShortReads(big), FILE_TYPE_POSIX_EXECUTABLE)
+                writer.add_iter("iter", uneven_chunks(big))
+                writer.add_iter("empty_iter", [])
+                with writer.open_item("write_from") as item:
+                    # Starts with a partial chunk pending.
+                    item.write(big[:100])
+                    item.write_from(ShortReads(big[100:]))
+                writer.add_directory("dir")
+                writer.add_symlink("dir/link", "../bytes")
+            expected = [
+                ("bytes", FILE_TYPE_NORMAL_FILE, big),
+                ("memoryview", FILE_TYPE_NORMAL_FILE, big[10:]),
+                ("exactly_one_chunk", FILE_TYPE_NORMAL_FILE, b"b" * 0xffff),
+                ("empty", FILE_TYPE_NORMAL_FILE, b""),
+                ("stream", FILE_TYPE_POSIX_EXECUTABLE, big),
+                ("iter", FILE_TYPE_NORMAL_FILE, big),
+                ("empty_iter", FILE_TYPE_NORMAL_FILE, b""),
+                ("write_from", FILE_TYPE_NORMAL_FILE, big),
+                ("dir", FILE_TYPE_DIRECTORY, b""),
+                ("dir/link", FILE_TYPE_SYMLINK, "../bytes"),
+            ]
+            def read_contents(reader, item):
+                buf = read_item(reader, item)
+                return item.symlink_target if item.file_type == FILE_TYPE_SYMLINK else buf
+            for index_cache_path in (None, archive_path + ".idx"):
+                with open_path(archive_path, index_cache_path=index_cache_path) as reader:
+                    expect_equal(expected, [(item.file_name_str, item.file_type, read_contents(reader, item)) for item in reader])
+            with open(archive_path, "rb") as f:
+                with reader_for_file(f, prefer_index=False) as reader:
+                    expect_equal(expected, [(item.file_name_str, item.file_type, read_contents(reader, item)) for item in reader])
+
+def test_async():
+    print("testing: async")
+    import asyncio
+    from async_archive import AsyncWriter, AsyncReader, open_stream
+
+    class Sink:
+        # Like an asyncio.StreamWriter.
+        def __init__(self):
+            self.output = io.BytesIO()
+            self.drain_count = 0
+        def write(self, buf):
+            self.output.write(buf)
+        async def drain(self):
+            self.drain_count += 1
+            await asyncio.sleep(0)
+
+    rng = random.Random(0)
+    big = bytes(rng.getrandbits(8) for _ in range(0x30000)) + b"a" * 0x50000
+
+    async def chunks(buf, size):
+        for i in range(0, len(buf), size):
+            await asyncio.sleep(0)
+            yield buf[i:i + size]
+
+    async def failing(size):
+        yield b"x" * size
+        raise OSError("source failed")
+
+    async def run(jobs):
+        sink = Sink()
+        async with AsyncWriter(sink, jobs=jobs) as writer:
+            await writer.add_bytes("bytes", big)
+            # Fails before anything is written for the item, which leaves no trace of it.
+            try:
+                await writer.add_iter("failed", failing(100))
+            except OSError: pass
+            else: assert False
+            await writer.add_iter("iter", chunks(big, 1000))
+            stream_reader = asyncio.StreamReader()
+            stream_reader.feed_data(big)
+            stream_reader.feed_eof()
+            await writer.add_stream("stream", stream_reader, FILE_TYPE_POSIX_EXECUTABLE)
+            await writer.add_iter("empty", [])
+            await writer.add_directory("dir")
+            await writer.add_symlink("dir/link", "../bytes")
+        assert sink.drain_count > 1
+        archive = sink.output.getvalue()
+        expected = [
+            ("bytes", big),
+            ("iter", big),
+            ("stream", big),
+            ("empty", b""),
+            ("dir", b""),
+            ("dir/link", b""),
+        ]
+
+        for source in (chunks(archive, 777), [asyncio.StreamReader()]):
+            if isinstance(source, list):
+                source[0].feed_data(archive)
+                source[0].feed_eof()
+                source = source[0]
+            async with await open_stream(source, read_ahead=0x1000) as reader:
+                found = []
+                async for item in reader:
+                    out = Sink()
+                    await reader.write_item_to(item, out)
+                    found.append((item.file_name_str, out.output.getvalue()))
+                expect_equal(expected, found)
+
+        async with AsyncReader(reader_for_file(archive)) as reader:
+            items = [item async for item in reader]
+            for item, (name, buf) in reversed(list(zip(items, expected))):
+                await reader.open_item(item)
+                out = Sink()
+                await reader.write_item_to(item, out)
+                expect_equal(buf, out.output.getvalue())
+        return archive
+
+    expect_equal(asyncio.run(run(1)), create_in_memory_archive(big))
+    asyncio.run(run(3))
+
+    async def fail_partway():
+        writer = AsyncWriter(Sink())
+        try:
+            await writer.add_iter("failed", failing(0x20000))
+        except OSError: pass
+        else: assert False
+        # Part of the item is already in the archive, so it can't be finished, but the item is no longer open.
+        try:
+            await writer.add_bytes("next", b"")
+        except ValueError as e:
+            assert "failed" in str(e)
+        else: assert False
+    asyncio.run(fail_partway())
+
+def test_rewrite():
+    print("testing: rewrite")
+    from rewrite import rewrite
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as d:
+        archives = []
+        for a in range(2):
+            archive_path = os.path.join(d, "archive{}.poaf".format(a))
+            contents = []
+            with Writer(root=None, output_path=archive_path, stream_split_threshold=0x1000) as writer:
+                for i in range(30):
+                    name = "f{:02}".format(i if a == 0 else i + 20)
+                    buf = bytes(rng.getrandbits(8) for _ in range(rng.randrange(3000))) + b"z" * rng.randrange(20000)
+                    writer.add_bytes(name, buf)
+                    contents.append((name, buf))
+                writer.add_directory("dir")
+                writer.add_symlink("dir/link", "../f00")
+            contents.extend([("dir", None), ("dir/link", "../f00")])
+            archives.append((archive_path, contents))
+
+        def check(output_path, expected):
+            # A streaming read validates the whole archive including the index.
+            with reader_for_file(read_file(output_path), prefer_index=False) as reader:
+                found = []
+                for item in reader:
+                    buf = read_item(reader, item)
+                    if item.file_type == FILE_TYPE_SYMLINK: buf = item.symlink_target
+                    if item.file_type == FILE_TYPE_DIRECTORY: buf = None
+                    found.append((item.file_name_str, buf))
+                expect_equal(expected, found)
+            with open_path(output_path) as reader:
+                for item, (_, buf) in reversed(list(zip(reader, expected))):
+                    if item.file_type == FILE_TYPE_NORMAL_FILE:
+                        expect_equal(buf, read_item(reader, item))
+
+        output_path = os.path.join(d, "output.poaf")
+        archive_path, contents = archives[0]
+        for keep in [
+            lambda i: True,
+            lambda i: i != 0,
+            lambda i: i != 5,
+            lambda i: i != len(contents) - 1,
+            lambda i: i % 2 == 0,
+            lambda i: i >= 10,
+        ]:
+            with open_path(archive_path) as reader:
+                entries = [(reader, item) for i, item in enumerate(reader) if keep(i)]
+                stats = rewrite(entries, output_path)
+            check(output_path, [x for i, x in enumerate(contents) if keep(i)])
+            expect_equal(len(entries), stats.copied_items + stats.recompressed_items)
+            if keep(0) and keep(len(contents) - 1):
+                assert stats.copied_items > 0
+        # Nothing changed, so nothing is recompressed.
+        with open_path(archive_path) as reader:
+            expect_equal(len(contents), rewrite([(reader, item) for item in reader], output_path).copied_items)
+        expect_equal(read_file(archive_path), read_file(output_path))
+
+        # Concatenate with the command line tool.
+        cmd = ["./rewrite.py", archives[0][0], archives[1][0], "--drop-shadowed", "--exclude", "f1*", "--output", output_path]
+        subprocess.run(cmd, cwd=this_dir, check=True)
+        expected = []
+        for name, buf in archives[0][1] + archives[1][1]:
+            if name.startswith("f1") or name in [x[0] for x in expected]: continue
+            expected.append((name, buf))
+        check(output_path, expected)
+
+        # Splitting before every item, including the first, so stream 0 is only item 0's DataItem header.
+        archive_path = os.path.join(d, "split_everywhere.poaf")
+        contents = archives[1][1][:5]
+        create_archive(archive_path, [(name, buf) for name, buf in contents if isinstance(buf, bytes)], stream_split_threshold=0)
+        with open_path(archive_path) as reader:
+            items = list(reader)
+            assert items[0].jump_location != 0
+            stats = rewrite([(reader, item) for item in items], output_path)
+        expect_equal(len(contents), stats.copied_items)
+        expect_equal(read_file(archive_path), read_file(output_path))
+        subprocess.run(["./read.py", "--verify", output_path], cwd=this_dir, check=True)
+        # Then item 0's stream can be copied after other items too.
+        with open_path(archives[0][0]) as first, open_path(archive_path) as second:
+            entries = [(first, item) for item in first if item.file_name_str == "f00"] + [(second, item) for item in second]
+            stats = rewrite(entries, output_path)
+        expect_equal(len(contents), stats.copied_items)
+        check(output_path, archives[0][1][:1] + contents)
+
+def test_streaming_block_size():
+    print("testing: streaming block size")
+    import read
+    rng = random.Random(0)
+    contents = [("f{}".format(i), b"x" * rng.choice([0, 1, 0xfffe, 0xffff, 0x10000, 70000])) for i in range(20)]
+    output = io.BytesIO()
+    with Writer(root=None, output_path=output, stream_split_threshold=0x100) as writer:
+        for name, buf in contents:
+            writer.add_bytes(name, buf)
+    original = read.stream_output_block_size
+    try:
+        # Fields and stream splits at every possible offset within the decompressed blocks.
+        for read.stream_output_block_size in (1, 7, 0x10001):
+            with reader_for_file(io.BytesIO(output.getvalue()), prefer_index=False) as reader:
+                expect_equal(contents, [(item.file_name_str, read_item(reader, item)) for item in reader])
+    finally:
+        read.stream_output_block_size = original
+
+def test_read_ahead():
+    print("testing: read ahead")
+    from read_ahead import ReadAheadFile
+
+    class SlowFile(io.RawIOBase):
+        # Like a pipe whose reads block until data arrives.
+        def __init__(self):
+            self.reading = threading.Event()
+            self.release = threading.Event()
+        def readable(self): return True
+        def readinto(self, b):
+            self.reading.set()
+            assert self.release.wait(10)
+            assert not self.closed
+            b[:1] = b"x"
+            return 1
+
+    with ReadAheadFile(io.BytesIO(b"abc" * 1000), block_size=7) as f:
+        expect_equal(b"abc" * 1000, f.read())
+
+    slow = SlowFile()
+    f = ReadAheadFile(slow)
+    assert slow.reading.wait(10)
+    # Closing while the thread is in the middle of a read must not close the file under it.
+    f.close()
+    assert not slow.closed
+    slow.release.set()
+    f._thread.join(10)
+    assert slow.closed
+
+def test_predicted_index():
+    print("testing: predicted index")
+    import read
+    rng = random.Random(0)
+    contents = [("f{}{}".format(i, "x" * rng.randrange(40)), bytes(rng.randrange(300))) for i in range(50)]
+
+    def create(tamper=None):
+        output = io.BytesIO()
+        create_archive(output, contents, tamper, stream_split_threshold=0x100)
+        return output.getvalue()
+
+    def stream(archive):
+        with reader_for_file(io.BytesIO(archive), prefer_index=False) as reader:
+            return [(item.file_name_str, read_item(reader, item)) for item in reader]
+
+    tampers = [
+        tamper_index(lambda name: name.startswith(b"f33"), file_size=lambda x: x + 1),
+        tamper_index(lambda name: name.startswith(b"f40"), name=lambda x: x[:-1] + b"y"),
+    ]
+
+    original = read.predicted_index_memory_budget, read.predicted_index_batch_size
+    try:
+        # All in memory, spilled every few items, and batches that don't line up with the spilled segments.
+        for read.predicted_index_memory_budget, read.predicted_index_batch_size in ((0x4000000, 0x1000), (200, 7), (0, 1)):
+            expect_equal(contents, stream(create()))
+            for tamper in tampers:
+                expect_raises(MalformedInputError, stream, create(tamper))
+    finally:
+        read.predicted_index_memory_budget, read.predicted_index_batch_size = original
+
+def test_verify():
+    print("testing: verify")
+    from read import verify
+    rng = random.Random(0)
+    contents = [("f{}".format(i), bytes(rng.getrandbits(8) for _ in range(rng.randrange(2000))) * rng.choice([1, 1, 40])) for i in range(30)]
+    contents[3] = ("empty", b"")
+    contents.extend([("dir", None), ("dir/link", "../f0")])
+
+    def create(archive_path, tamper=None):
+        create_archive(archive_path, contents, tamper, stream_split_threshold=0x400, max_skip_bytes=0x2000)
+
+    tampers = [
+        tamper_index(lambda name: name == b"f7", contents_crc32=lambda x: x ^ 1),
+        tamper_index(lambda name: name == b"f20", file_size=lambda x: x + 1),
+        # Every stream split but the first is off by one.
+        tamper_index(lambda name: name != b"f0", jump_location=lambda x: x + 1 if x != 0 else 0),
+        # A stream split that isn't there.
+        tamper_index(lambda name: name == b"f25", jump_location=lambda x: 100),
+    ]
+
+    with tempfile.TemporaryDirectory() as d:
+        archive_path = os.path.join(d, "archive.poaf")
+        create(archive_path)
+        for jobs in ("1", "3"):
+            subprocess.run(["./read.py", "--verify", "--jobs", jobs, archive_path], cwd=this_dir, check=True)
+        with open(archive_path, "rb") as f:
+            subprocess.run(["./read.py", "--verify", "-"], stdin=f, cwd=this_dir, check=True)
+
+        for tamper in tampers:
+            create(archive_path, tamper)
+            expect_raises(MalformedInputError, verify, archive_path, jobs=3)
+            # Parallel extraction checks the same things as it goes.
+            with tempfile.TemporaryDirectory() as output_dir:
+                result = subprocess.run(["./read.py", archive_path, "-x", output_dir, "--jobs", "2"], cwd=this_dir, stderr=subprocess.PIPE)
+                assert result.returncode != 0 and b"MalformedInputError" in result.stderr, result.stderr
+
+        # No items.
+        with Writer(root=None, output_path=archive_path, stream_split_threshold=0x400):
+            pass
+        verify(archive_path)
+
+def test_parallel_crc():
+    print("testing: parallel crc")
+    from parallel_crc import ParallelCrc32, crc32_combine, crc32_combine_python, crc32_both
+    rng = random.Random(0)
+    for _ in range(100):
+        a = rng.randbytes(rng.randrange(100))
+        b = rng.randbytes(rng.choice([0, 1, rng.randrange(0x20000)]))
+        value = rng.getrandbits(32)
+        for combine in (crc32_combine, crc32_combine_python):
+            expect_equal(zlib.crc32(a + b, value), combine(zlib.crc32(a, value), zlib.crc32(b), len(b)))
+        expect_equal((zlib.crc32(b, value), zlib.crc32(b, 5)), crc32_both(b, value, 5))
+
+    buf = rng.randbytes(0x10000) * 40
+    with ParallelCrc32(3, piece_size=0x30000) as engine:
+        expect_equal(zlib.crc32(buf, 7), engine.crc32(buf, 7))
+        expect_equal([zlib.crc32(buf[i:i + 0xffff]) for i in range(0, len(buf), 0xffff)], engine.chunk_crc32s(buf, 0xffff))
+
+    # The writer's crc32s, read back by a validating streaming read.
+    with tempfile.TemporaryDirectory() as d:
+        input_path = os.path.join(d, "input")
+        with open(input_path, "wb") as f:
+            f.write(buf[:-5])
+        output = io.BytesIO()
+        with Writer(root=None, output_path=output, stream_split_threshold=0x10000, jobs=3) as writer:
+            writer.add_entry(input_path, "file", FILE_TYPE_NORMAL_FILE)
+            writer.add_bytes("bytes", buf[5:])
+            writer.add_bytes("small", b"small")
+        with reader_for_file(io.BytesIO(output.getvalue()), prefer_index=False) as reader:
+            expect_equal([("file", buf[:-5]), ("bytes", buf[5:]), ("small", b"small")], [(item.file_name_str, read_item(reader, item)) for item in reader])
+
+def test_directory_cache():
+    print("testing: directory cache")
+    from read import DirectoryCache, extract_item
+    with tempfile.TemporaryDirectory() as d:
+        archive_path = os.path.join(d, "archive.poaf")
+        with Writer(root=None, output_path=archive_path, stream_split_threshold=0x10000) as writer:
+            writer.add_bytes("a/b/c/deep", b"deep")
+            writer.add_bytes("a/x", b"x", FILE_TYPE_POSIX_EXECUTABLE)
+            writer.add_directory("a/b/empty")
+            writer.add_bytes("d/e/f", b"f")
+            writer.add_symlink("a/b/link", "c/deep")
+            writer.add_bytes("a/b/c/deeper/g", b"g")
+            writer.add_bytes("top", b"top")
+
+        output_dir = os.path.join(d, "output")
+        os.mkdir(output_dir)
+        open_fds = len(os.listdir("/proc/self/fd")) if os.path.isdir("/proc/self/fd") else None
+        # Evict every directory as soon as another one is used.
+        with open_path(archive_path) as reader, DirectoryCache(output_dir, max_open=1) as directories:
+            for item in reader:
+                reader.open_item(item)
+                extract_item(directories, reader, item)
+        if open_fds != None:
+            expect_equal(open_fds, len(os.listdir("/proc/self/fd")))
+        expect_equal(b"deep", read_file(os.path.join(output_dir, "a", "b", "link")))
+        expect_equal(b"g", read_file(os.path.join(output_dir, "a", "b", "c", "deeper", "g")))
+        expect_equal(b"f", read_file(os.path.join(output_dir, "d", "e", "f")))
+        expect_equal(b"top", read_file(os.path.join(output_dir, "top")))
+        assert os.path.isdir(os.path.join(output_dir, "a", "b", "empty"))
+        if os.name == "posix":
+            assert os.stat(os.path.join(output_dir, "a", "x")).st_mode & 0o100
+            assert not os.stat(os.path.join(output_dir, "top")).st_mode & 0o100
+
+        # Colliding names are rejected rather than overwriting the first item, however the archive is extracted.
+        create_archive(archive_path, [("x", b"first"), ("y", b"y"), ("x", b"second")], stream_split_threshold=0x10000)
+        for mode in ([], ["--pipeline"], ["--jobs", "2"]):
+            output_dir = os.path.join(d, "collision" + "".join(mode))
+            os.mkdir(output_dir)
+            result = subprocess.run(["./read.py", archive_path, "-x", output_dir] + mode, cwd=this_dir, stderr=subprocess.PIPE)
+            assert result.returncode != 0 and b"FileExistsError" in result.stderr, (mode, result.stderr)
+
+        # An ancestor that's a symlink is rejected rather than followed, even to somewhere inside the extraction directory.
+        create_archive(archive_path, [("a", "."), ("a/x", b"x")], stream_split_threshold=0x10000)
+        for mode in ([], ["--pipeline"], ["--jobs", "2"]):
+            output_dir = os.path.join(d, "symlink" + "".join(mode))
+            os.mkdir(output_dir)
+            result = subprocess.run(["./read.py", archive_path, "-x", output_dir] + mode, cwd=this_dir, stderr=subprocess.PIPE)
+            assert result.returncode != 0, mode
+            assert not os.path.exists(os.path.join(output_dir, "x")), mode
+        with DirectoryCache(output_dir) as directories:
+            expect_raises(OSError, directories.parent, "a/x")
+        import read
+        original = read._use_dir_fd
+        try:
+            read._use_dir_fd = False
+            with DirectoryCache(output_dir) as directories:
+                expect_raises(NotADirectoryError, directories.parent, "a/x")
+        finally:
+            read._use_dir_fd = original
+
+        # A pipelined worker closes a file whose contents end early, such as when the reader fails partway.
+        from read import _ExtractWorker
+        import types, warnings
+        output_dir = os.path.join(d, "partial")
+        os.mkdir(output_dir)
+        with warnings.catch_warnings(record=True) as caught:
+            # Left to the garbage collector, the file would be closed with a ResourceWarning.
+            warnings.simplefilter("always", ResourceWarning)
+            worker = _ExtractWorker(output_dir)
+            worker.put((types.SimpleNamespace(file_name_str="partial", file_type=FILE_TYPE_NORMAL_FILE), b"p" * 0xFFFF))
+            worker.flush()
+            worker.finish()
+            worker.raise_error()
+        expect_equal([], [w for w in caught if issubclass(w.category, ResourceWarning)])
+        expect_equal(b"p" * 0xFFFF, read_file(os.path.join(output_dir, "partial")))
+
+        # Duplicate directories are fine.
+        create_archive(archive_path, [("dir", None), ("dir/x", b"x"), ("dir", None)], stream_split_threshold=0x10000)
+        for mode in ([], ["--pipeline"], ["--jobs", "2"]):
+            output_dir = os.path.join(d, "directories" + "".join(mode))
+            os.mkdir(output_dir)
+            subprocess.run(["./read.py", archive_path, "-x", output_dir] + mode, cwd=this_dir, check=True)
+            expect_equal(b"x", read_file(os.path.join(output_dir, "dir", "x")))
+
+def create_archive(output_path, contents, tamper=None, **kwargs):
+    """
+    contents is a list of (name, contents), where contents is bytes for a file,
+    None for a directory, or a str for a symlink target.
+    Other keyword arguments are passed to Writer. See tamper_index() for tamper.
+    """
+    with Writer(root=None, output_path=output_path, **kwargs) as writer:
+        if tamper != None:
+            add_index_item = writer._add_index_item
+            writer._add_index_item = lambda *args: add_index_item(*tamper(*args))
+        for name, buf in contents:
+            if buf == None:
+                writer.add_directory(name)
+            elif isinstance(buf, str):
+                writer.add_symlink(name, buf)
+            else:
+                writer.add_bytes(name, buf)
+
+def tamper_index(match, **changes):
+    """
+    Returns a function for create_archive() that corrupts the IndexItems whose names (bytes) match,
+    by applying the given function to each named field,
+    e.g. tamper_index(lambda name: name == b"x", file_size=lambda x: x + 1).
+    """
+    fields = ("jump_location", "file_size", "contents_crc32", "type_and_name_size", "name")
+    def tamper(*args):
+        if not match(args[-1]): return args
+        return tuple(changes[field](value) if field in changes else value for field, value in zip(fields, args))
+    return tamper
+
+def expect_raises(error_type, fn, *args, **kwargs):
+    try:
+        fn(*args, **kwargs)
+    except error_type:
+        return
+    raise AssertionError("expected " + error_type.__name__)
+
+def create_in_memory_archive(big):
+    # What AsyncWriter should be doing with jobs=1.
+    output = io.BytesIO()
+    with Writer(root=None, output_path=output, stream_split_threshold=0x10000) as writer:
+        writer.add_bytes("bytes", big)
+        writer.add_bytes("iter", big)
+        writer.add_bytes("stream", big, FILE_TYPE_POSIX_EXECUTABLE)
+        writer.add_bytes("empty", b"")
+        writer.add_directory("dir")
+        writer.add_symlink("dir/link", "../bytes")
+    return output.getvalue()
+
+def read_item(reader, item):
+    reader.open_item(item)
+    buf = io.BytesIO()
+    while not item.done:
+        buf.write(reader.read_from_item(item))
+    return buf.getvalue()
+
 def assert_dir(d, file_name_args, file_names):
     found_files = os.listdir(d)
     assert set(found_files) == set(file_names)